@@ -0,0 +1,97 @@
+"""Benchmarks of the collate functions in kipoi_utils.data_utils
+
+Reports the time, peak RSS, page faults and large-array allocations per batch
+of collating large batches with and without recycled buffers (`BufferRing`).
+Each mode runs in a separate process so that the peak RSS is not shared.
+
+Also reports the time per batch of collating small nested samples with
+many leaves, where the per-batch dispatch of the collate dominates.
+
+Usage:
+    python benchmarks/bench_collate.py
+"""
+import multiprocessing
+import resource
+import time
+import tracemalloc
+import numpy as np
+from kipoi_utils.data_utils import numpy_collate, CompiledCollate, BufferRing
+
+
+def make_samples(batch_size, seq_len):
+    return [{"inputs": {"seq": np.random.rand(seq_len, 4).astype(np.float32)},
+             "targets": np.float32(i)}
+            for i in range(batch_size)]
+
+
+def make_nested_samples(batch_size):
+    return [{"inputs": {"seq": np.zeros((100, 4), np.float32), "dist": np.float32(i)},
+             "targets": [np.float32(i), np.zeros(3)],
+             "metadata": {"ranges": {"chr": "chr1", "start": i, "end": i + 100,
+                                     "id": str(i), "strand": "+"},
+                          "gene": "G{}".format(i)}}
+            for i in range(batch_size)]
+
+
+def run(mode, n_batches, batch_size, seq_len, result_queue):
+    samples = make_samples(batch_size, seq_len)
+    if mode == 'numpy_collate':
+        collate = numpy_collate
+    elif mode == 'compiled':
+        collate = CompiledCollate()
+    else:
+        collate = CompiledCollate(BufferRing())
+    collate(samples)
+
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start = time.time()
+    for _ in range(n_batches):
+        batch = collate(samples)
+        del batch
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    # count the collate calls allocating memory of the size of the output
+    # (numpy reports its allocations to tracemalloc, python >= 3.9 for reset_peak)
+    batch_nbytes = batch_size * seq_len * 4 * 4
+    n_allocs = 0
+    tracemalloc.start()
+    for _ in range(n_batches):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        batch = collate(samples)
+        del batch
+        n_allocs += tracemalloc.get_traced_memory()[1] - before >= batch_nbytes
+    tracemalloc.stop()
+    result_queue.put((mode, elapsed / n_batches, usage.ru_maxrss,
+                      (usage.ru_minflt - faults) / n_batches, n_allocs / n_batches))
+
+
+def bench_collate(n_batches=50, batch_size=256, seq_len=10000):
+    print("collate batches of {:.0f}MB:".format(batch_size * seq_len * 16 / 2**20))
+    result_queue = multiprocessing.Queue()
+    for mode in ['numpy_collate', 'compiled', 'buffer_ring']:
+        p = multiprocessing.Process(target=run, args=(mode, n_batches, batch_size, seq_len,
+                                                      result_queue))
+        p.start()
+        mode, t, maxrss, faults, allocs = result_queue.get()
+        p.join()
+        print("{:>14}: {:.2f}ms/batch, peak RSS {:.0f}MB, {:.0f} page faults/batch, "
+              "{:.2f} large allocations/batch".format(mode, t * 1000, maxrss / 1024, faults, allocs))
+
+
+def bench_nested_collate(n_batches=2000, batch_size=64):
+    print("collate nested samples with 10 leaves, batch size {}:".format(batch_size))
+    samples = make_nested_samples(batch_size)
+    for mode, collate in [('numpy_collate', numpy_collate), ('compiled', CompiledCollate())]:
+        collate(samples)
+        start = time.time()
+        for _ in range(n_batches):
+            collate(samples)
+        elapsed = time.time() - start
+        print("{:>14}: {:.1f}us/batch".format(mode, elapsed / n_batches * 1e6))
+
+
+if __name__ == '__main__':
+    bench_collate()
+    bench_nested_collate()
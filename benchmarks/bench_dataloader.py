@@ -0,0 +1,58 @@
+"""Benchmarks of the DataLoader in kipoi_utils.external.torch
+
+Usage:
+    python benchmarks/bench_dataloader.py
+"""
+import time
+import numpy as np
+from kipoi_utils.external.torch.data import DataLoader
+
+
+class PerSampleDataset(object):
+    """One-hot encoded sequences loaded one sample at a time"""
+
+    def __init__(self, n=100000, seq_len=100):
+        self.seqs = np.random.rand(n, seq_len, 4).astype(np.float32)
+        self.targets = np.random.rand(n).astype(np.float32)
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def __getitem__(self, idx):
+        return {"inputs": self.seqs[idx],
+                "targets": self.targets[idx]}
+
+
+class BatchedDataset(PerSampleDataset):
+    """Same as PerSampleDataset but loading whole batches with a single fancy-index"""
+
+    def get_batch(self, indices):
+        return {"inputs": self.seqs[indices],
+                "targets": self.targets[indices]}
+
+
+def timeit(fn, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def bench_batched_access(batch_size=128, **kwargs):
+    def run(dataset):
+        def fn():
+            for _ in DataLoader(dataset, batch_size=batch_size, shuffle=True, **kwargs):
+                pass
+        return timeit(fn)
+
+    t_sample = run(PerSampleDataset())
+    t_batch = run(BatchedDataset())
+    print("batched access {}: per-sample {:.3f}s, get_batch {:.3f}s, speedup {:.1f}x".format(
+        kwargs, t_sample, t_batch, t_sample / t_batch))
+
+
+if __name__ == '__main__':
+    bench_batched_access()
+    bench_batched_access(num_workers=2, worker_backend='thread')
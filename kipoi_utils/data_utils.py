@@ -1,11 +1,16 @@
 """Useful utilities for data-loading
 """
+import asyncio
+import json
+import os
 import numpy as np
 import sys
 import collections
+import queue
+import threading
+import weakref
 from kipoi_utils.utils import map_nested
 import pandas as pd
-from kipoi_utils.external.flatten_json import flatten
 
 # string_classes
 if sys.version_info[0] == 2:
@@ -49,18 +54,389 @@ numpy_collate = _numpy_collate(np.stack)
 numpy_collate_concat = _numpy_collate(np.concatenate)
 
 
+class BufferRing(object):
+    """Stack function writing the batches into recycled, preallocated buffers
+
+    Drop-in replacement of `np.stack` / `np.concatenate` as the `stack_fn` of the
+    collate functions (e.g. ``CompiledCollate(BufferRing())``). Keeps up to
+    `num_buffers` free output buffers per (shape, dtype) and copies the samples
+    directly into a free buffer with ``out=`` instead of allocating a new array for
+    every batch. A buffer is recycled once the consumer released all the views of
+    the returned array.
+
+    Args:
+      stack_fn: `np.stack` or `np.concatenate`
+      num_buffers: maximal number of free buffers kept per (shape, dtype)
+      min_bytes: smaller outputs are allocated as usual
+    """
+
+    def __init__(self, stack_fn=np.stack, num_buffers=2, min_bytes=2**16):
+        self.stack_fn = stack_fn
+        self.num_buffers = num_buffers
+        self.min_bytes = min_bytes
+        # (shape, dtype) -> free buffers
+        self._free = {}
+        self._lock = threading.Lock()
+        # number of buffers allocated so far
+        self.allocations = 0
+
+    def __getstate__(self):
+        # each process gets its own buffers
+        return {'stack_fn': self.stack_fn, 'num_buffers': self.num_buffers,
+                'min_bytes': self.min_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _out_shape(self, arrays):
+        first = arrays[0]
+        if not isinstance(first, np.ndarray) or first.dtype.hasobject:
+            return None
+        if self.stack_fn is np.stack:
+            if any(type(x) is not np.ndarray or x.shape != first.shape or x.dtype != first.dtype
+                   for x in arrays):
+                return None
+            return (len(arrays),) + first.shape
+        elif self.stack_fn is np.concatenate and first.ndim > 0:
+            if any(type(x) is not np.ndarray or x.shape[1:] != first.shape[1:] or x.dtype != first.dtype
+                   for x in arrays):
+                return None
+            return (sum(len(x) for x in arrays),) + first.shape[1:]
+        return None
+
+    def __call__(self, arrays, axis=0):
+        shape = self._out_shape(arrays) if axis == 0 else None
+        if shape is None or int(np.prod(shape)) * arrays[0].dtype.itemsize < self.min_bytes:
+            return self.stack_fn(arrays, axis)
+        out = self._get_buffer(shape, arrays[0].dtype)
+        self.stack_fn(arrays, axis, out=out)
+        return out
+
+    def _get_buffer(self, shape, dtype):
+        key = (shape, dtype.str)
+        with self._lock:
+            free = self._free.get(key)
+            raw = free.pop() if free else None
+        if raw is None:
+            raw = np.empty(int(np.prod(shape)) * dtype.itemsize, dtype=np.uint8)
+            self.allocations += 1
+        # all the views of the returned array keep `base` alive
+        base = np.frombuffer(memoryview(raw), dtype=dtype)
+        weakref.finalize(base, self._release, key, raw)
+        return base.reshape(shape)
+
+    def _release(self, key, raw):
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if len(free) < self.num_buffers:
+                free.append(raw)
+
+
+class _SchemaMismatch(Exception):
+    """The batch doesn't have the structure the collate plan was compiled for"""
+
+
+def _compile_leaf_collate(elem, stack_fn):
+    """Collate function of a leaf specialized for the type of `elem`
+
+    The returned function raises `_SchemaMismatch` if the first value has another type.
+    Returns None for leaves not supported by `numpy_collate`.
+    """
+    elem_type = type(elem)
+    if elem_type is np.ndarray:
+        if stack_fn is np.stack and elem.ndim > 0:
+            def collate(values):
+                shape = values[0].shape
+                if (type(values[0]) is not np.ndarray or
+                        [x.shape for x in values].count(shape) != len(values)):
+                    raise _SchemaMismatch()
+                # same as np.stack without expanding every array
+                return np.concatenate(values).reshape((len(values),) + shape)
+        else:
+            def collate(values):
+                if type(values[0]) is not np.ndarray:
+                    raise _SchemaMismatch()
+                return stack_fn(values, 0)
+    elif elem_type.__module__ == 'numpy' and getattr(elem, 'shape', None) == ():  # scalars
+        if elem.dtype.kind in 'biufc':
+            collate = _fromiter_collate(elem_type, elem.dtype, np.array)
+        else:
+            # the dtype of strings or datetimes depends on every value
+            collate = _same_type_collate(elem_type, np.array)
+    elif elem_type in (int, float, bool):
+        collate = _fromiter_collate(elem_type, np.asarray(elem).dtype, np.asarray)
+    elif elem is None or isinstance(elem, (int, float) + string_classes):
+        collate = _same_type_collate(elem_type, np.asarray)
+    else:
+        return None
+    return collate
+
+
+def _same_type_collate(elem_type, to_array):
+    """Collate the values with `to_array` if the first value has type `elem_type`
+    """
+    def collate(values):
+        if type(values[0]) is not elem_type:
+            raise _SchemaMismatch()
+        return to_array(values)
+    return collate
+
+
+def _fromiter_collate(elem_type, dtype, to_array):
+    """Collate scalars of type `elem_type` with `np.fromiter` if all the values have that type
+    """
+    def collate(values):
+        if type(values[0]) is not elem_type:
+            raise _SchemaMismatch()
+        if set(map(type, values)) == {elem_type}:
+            try:
+                return np.fromiter(values, dtype, len(values))
+            except OverflowError:
+                # python ints out of the range of `dtype`
+                pass
+        return to_array(values)
+    return collate
+
+
+class CompiledCollate(object):
+    """Collate function compiling the structure of the samples into a flat plan
+
+    Equivalent to `numpy_collate`. The nested structure of the first sample is compiled
+    once into flat lists of steps operating on numbered slots (slot 0 is the batch):
+
+    - `gather`: ``(slot, parent_slot, key)``, collects ``x[key]`` for the values ``x``
+      of the parent slot, i.e. transposes one level of the batch
+    - `checks`: ``(slot, type, len)`` of the containers, checked on the first sample
+    - `leaves`: ``(slot, collate_fn)``, stacks the values of a leaf with a function
+      specialized for its type (e.g. `np.fromiter` for scalars)
+    - `build`: ``(slot, is_dict, children)``, rebuilds the nested batch bottom-up
+
+    `leaf_paths` lists the paths of the leaves. The plan is re-used as long as the batches
+    keep the same structure, otherwise the batch is collated with the generic `numpy_collate`.
+
+    Args:
+      stack_fn: function merging the numpy arrays, `np.stack` or `np.concatenate`
+    """
+
+    def __init__(self, stack_fn=np.stack):
+        self.stack_fn = stack_fn
+        self.generic = _numpy_collate(stack_fn)
+        self.compiled = False
+        self.gather = self.checks = self.leaves = self.build = self.leaf_paths = None
+
+    def __getstate__(self):
+        # the plan and the generic collate hold closures. Compile again after unpickling
+        return {'stack_fn': self.stack_fn}
+
+    def __setstate__(self, state):
+        self.__init__(state['stack_fn'])
+
+    def _compile(self, elem):
+        self.gather, self.checks, self.leaves, self.build, self.leaf_paths = [], [], [], [], []
+        self.n_slots = 1
+        try:
+            self._compile_node(elem, 0, ())
+        except _SchemaMismatch:
+            # not supported by the plan
+            self.leaves = None
+        self.compiled = True
+
+    def _compile_node(self, elem, slot, path):
+        if isinstance(elem, collections.abc.Mapping) or (
+                isinstance(elem, collections.abc.Sequence) and not isinstance(elem, string_classes)):
+            is_dict = isinstance(elem, collections.abc.Mapping)
+            self.checks.append((slot, type(elem), len(elem)))
+            children = []
+            for key in (elem if is_dict else range(len(elem))):
+                child = self.n_slots
+                self.n_slots += 1
+                self.gather.append((child, slot, key))
+                self._compile_node(elem[key], child, path + (key,))
+                children.append((key, child))
+            # children are built before their parents
+            self.build.append((slot, is_dict, children))
+        else:
+            collate = _compile_leaf_collate(elem, self.stack_fn)
+            if collate is None:
+                raise _SchemaMismatch()
+            self.leaves.append((slot, collate))
+            self.leaf_paths.append(path)
+
+    def __call__(self, batch):
+        if not self.compiled:
+            self._compile(batch[0])
+        if self.leaves is None:
+            return self.generic(batch)
+        slots = [None] * self.n_slots
+        slots[0] = batch
+        try:
+            for slot, parent, key in self.gather:
+                slots[slot] = [x[key] for x in slots[parent]]
+            for slot, elem_type, n in self.checks:
+                first = slots[slot][0]
+                if type(first) is not elem_type or len(first) != n:
+                    raise _SchemaMismatch()
+            for slot, collate in self.leaves:
+                slots[slot] = collate(slots[slot])
+        except (_SchemaMismatch, KeyError, IndexError, TypeError, AttributeError):
+            # different structure. The generic collate also raises the genuine errors
+            return self.generic(batch)
+        for slot, is_dict, children in self.build:
+            if is_dict:
+                slots[slot] = {key: slots[child] for key, child in children}
+            else:
+                slots[slot] = [slots[child] for _, child in children]
+        return slots[0]
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _encode_strings(batch):
+    return [np.frombuffer(x.encode('utf-8') if isinstance(x, str) else x, dtype=np.uint8)
+            for x in batch]
+
+
+def pad_collate(arrays, pad_value=0):
+    """Pad the arrays along the first axis to the longest one
+
+    Returns:
+      dict with the padded array of shape ``(batch, max_len, ...)`` under ``"values"``
+      and the original lengths under ``"lengths"``. The mask of the valid elements
+      is ``np.arange(max_len) < lengths[:, None]``.
+    """
+    lengths = np.array([len(x) for x in arrays], dtype=np.int64)
+    trailing = arrays[0].shape[1:]
+    if any(x.shape[1:] != trailing for x in arrays):
+        raise ValueError("arrays can only differ in the length of the first axis")
+    out = np.full((len(arrays), lengths.max() if len(arrays) else 0) + trailing, pad_value,
+                  dtype=np.result_type(*arrays))
+    for i, x in enumerate(arrays):
+        out[i, :len(x)] = x
+    return {"values": out, "lengths": lengths}
+
+
+def ragged_collate(arrays):
+    """Concatenate the arrays along the first axis
+
+    Returns:
+      dict with the concatenated array under ``"values"`` and the ``batch + 1`` offsets
+      of the samples under ``"offsets"``: sample ``i`` is ``values[offsets[i]:offsets[i + 1]]``.
+    """
+    return {"values": np.concatenate(arrays),
+            "offsets": _offsets([len(x) for x in arrays])}
+
+
+def ragged_to_list(ragged):
+    """Split a ragged leaf (see `ragged_collate`) into the list of arrays
+    """
+    return np.split(ragged["values"], ragged["offsets"][1:-1])
+
+
+def decode_strings(ragged, encoding='utf-8'):
+    """Decode the strings of a ragged leaf produced by `RaggedCollate`
+    """
+    buf = ragged["values"].tobytes()
+    offsets = ragged["offsets"].tolist()
+    return [buf[start:end].decode(encoding) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class RaggedCollate(object):
+    """Collate function for samples with variable-length leaves
+
+    The collation mode of each leaf, identified by its path (e.g. ``"inputs/seq"``), is one of:
+
+    - ``"stack"``: stack the arrays as in `numpy_collate`
+    - ``"pad"``: padded array plus lengths (see `pad_collate`)
+    - ``"ragged"``: flat values plus offsets (see `ragged_collate`)
+    - ``"auto"``: ``"stack"`` for arrays of the same shape, ``"pad"`` for arrays of
+      different lengths and ``"ragged"`` for strings
+
+    Strings collated with ``"pad"`` or ``"ragged"`` are encoded as utf-8 into a flat
+    uint8 buffer instead of a fixed-width unicode array (see `decode_strings`).
+    Padded strings are always padded with 0.
+    Numbers and other leaves are always collated as in `numpy_collate`.
+
+    Args:
+      modes: dictionary mapping leaf paths to collation modes
+      default: collation mode of the leaves not in `modes`
+      pad_value: value of the padded elements
+      nested_sep: separator of the path elements
+    """
+    MODES = ("auto", "stack", "pad", "ragged")
+
+    def __init__(self, modes=None, default="auto", pad_value=0, nested_sep="/"):
+        self.modes = dict(modes or {})
+        for mode in list(self.modes.values()) + [default]:
+            if mode not in self.MODES:
+                raise ValueError("Unknown collation mode: {}. Use one of {}".format(mode, self.MODES))
+        self.default = default
+        self.pad_value = pad_value
+        self.nested_sep = nested_sep
+
+    def __call__(self, batch):
+        return self._collate(batch, [])
+
+    def _collate(self, batch, path):
+        elem = batch[0]
+        is_string = isinstance(elem, string_classes)
+        if is_string or (isinstance(elem, np.ndarray) and elem.ndim > 0):
+            mode = self.modes.get(self.nested_sep.join(path), self.default)
+            return self._collate_leaf(batch, mode, is_string)
+        elif isinstance(elem, collections.abc.Mapping):
+            return {key: self._collate([d[key] for d in batch], path + [str(key)]) for key in elem}
+        elif isinstance(elem, collections.abc.Sequence):
+            return [self._collate(samples, path + [str(i)])
+                    for i, samples in enumerate(zip(*batch))]
+        return numpy_collate(batch)
+
+    def _collate_leaf(self, batch, mode, is_string):
+        if mode == "auto":
+            if is_string:
+                mode = "ragged"
+            elif all(x.shape == batch[0].shape for x in batch):
+                mode = "stack"
+            else:
+                mode = "pad"
+        if mode == "stack":
+            return numpy_collate(batch)
+        if is_string:
+            batch = _encode_strings(batch)
+        if mode == "pad":
+            # pad_value may not fit into the uint8 of the encoded strings
+            return pad_collate(batch, 0 if is_string else self.pad_value)
+        return ragged_collate(batch)
+
+
 # ----------------------------------------------
 
 
-def batch_gen(iterable, batch_size=32):
+def batch_gen(iterable, batch_size=32, prefetch=0):
     """Create a batch generator
 
     Args:
-       iterable: an iterable object iterating over samples
+       iterable: an iterable object iterating over samples. A numpy array or a
+         nested dictionary of numpy arrays (see `get_dataset_item`) is batched directly
+         by slicing; the batches are then views of the arrays.
        batch_size: batch size
+       prefetch: number of batches prepared ahead in a background thread.
+         If 0, the batches are prepared in the calling thread.
     Returns:
        batch generator
     """
+    if isinstance(iterable, (np.ndarray, collections.abc.Mapping)):
+        gen = _slice_batch_gen(iterable, batch_size)
+    else:
+        gen = _collate_batch_gen(iterable, batch_size)
+    if prefetch > 0:
+        gen = _prefetch_gen(gen, prefetch)
+    return gen
+
+
+def _collate_batch_gen(iterable, batch_size):
     l = []
     for x in iterable:
         l.append(x)
@@ -74,6 +450,57 @@ def batch_gen(iterable, batch_size=32):
         yield numpy_collate(l)
 
 
+def _slice_batch_gen(data, batch_size):
+    lens = get_dataset_lens(data, require_numpy=True)
+    if len(set(lens)) > 1:
+        raise ValueError("All numpy arrays need to have the same length")
+    n = lens[0] if lens else 0
+    for start in range(0, n, batch_size):
+        yield get_dataset_item(data, slice(start, start + batch_size))
+
+
+def _prefetch_gen(gen, prefetch):
+    """Run the generator in a background thread, `prefetch` items ahead
+    """
+    q = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # give up once the consumer is gone
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in gen:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+
+    t = threading.Thread(target=producer)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            item, exc = q.get()
+            if exc is not None:
+                raise exc
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 class DataloaderIterable(object):
     """Create an iterable from a dataloader - helper class
     """
@@ -85,28 +512,150 @@ class DataloaderIterable(object):
     def __iter__(self):
         return self.dl_obj.batch_iter(**self.kwargs)
 
+    def __aiter__(self):
+        it = self.dl_obj.batch_iter(**self.kwargs)
+        if hasattr(it, '__anext__'):
+            # e.g. DataLoaderIter waiting for the workers on the event loop
+            return it
+        return _ExecutorAsyncIterator(it)
+
+
+class _ExecutorAsyncIterator(object):
+    """Asynchronous iterator running `next` of a plain iterator in the default executor
+    """
+
+    def __init__(self, it):
+        self.it = it
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        sentinel = object()
+        batch = await asyncio.get_event_loop().run_in_executor(None, next, self.it, sentinel)
+        if batch is sentinel:
+            raise StopAsyncIteration
+        return batch
+
+
+# --------------------------------------------
+# Post-collate batch transforms (see DataLoader(transforms=...))
+
+
+def _update_nested(batch, keys, fn):
+    """Copy of the nested batch with `fn` applied to the element at path `keys`
+    """
+    if not keys:
+        return fn(batch)
+    if isinstance(batch, collections.abc.Mapping):
+        out = dict(batch)
+        out[keys[0]] = _update_nested(batch[keys[0]], keys[1:], fn)
+        return out
+    elif isinstance(batch, list):
+        out = list(batch)
+        out[int(keys[0])] = _update_nested(batch[int(keys[0])], keys[1:], fn)
+        return out
+    else:
+        raise ValueError("Unable to index {} with {}".format(type(batch), keys[0]))
+
+
+def map_batch(fn, path=None, nested_sep="/"):
+    """Create a batch transform applying a function to numpy arrays of the batch
+
+    Args:
+      fn: function applied to the numpy arrays
+      path: apply `fn` only to the array at this path of the nested batch
+        (e.g. "inputs/seq"). If None, `fn` is applied to all the numpy arrays.
+      nested_sep: separator of the path elements
+
+    Returns:
+      function transforming the batch
+    """
+    keys = path.split(nested_sep) if path else None
+
+    def transform(batch):
+        if keys is None:
+            return map_nested(batch, lambda x: fn(x) if isinstance(x, np.ndarray) else x)
+        return _update_nested(batch, keys, fn)
+
+    return transform
+
+
+def cast_transform(dtype=np.float32, from_dtype=np.float64, path=None):
+    """Cast the arrays of type `from_dtype` to `dtype`
+    """
+    from_dtype = np.dtype(from_dtype)
+    return map_batch(lambda x: x.astype(dtype) if x.dtype == from_dtype else x, path)
+
+
+def normalize_transform(mean, std, path=None):
+    """Normalize the arrays: (x - mean) / std
+    """
+    return map_batch(lambda x: (x - mean) / std, path)
+
+
+def contiguous_transform(path=None):
+    """Convert the arrays to C-contiguous arrays
+    """
+    return map_batch(np.ascontiguousarray, path)
+
+
+def reverse_complement_transform(path=None, p=0.5, seq_axis=1, seed=None):
+    """Reverse-complement augmentation of one-hot encoded sequences
+
+    Reverse-complements a random subset of the samples in the batch.
+    Assumes the alphabet (e.g. ACGT) is on the last axis and ordered
+    such that reversing it yields the complement.
+
+    Args:
+      path: path of the one-hot encoded sequences in the batch
+      p: probability of reverse-complementing a sample
+      seq_axis: sequence axis of the batched array
+      seed: random seed
+    """
+    rng = np.random.RandomState(seed)
+
+    def rc(x):
+        mask = rng.uniform(size=len(x)) < p
+        if not mask.any():
+            return x
+        x = x.copy()
+        x[mask] = np.flip(np.flip(x[mask], seq_axis), -1)
+        return x
+
+    return map_batch(rc, path)
+
 
 # --------------------------------------------
 # Tools for working with a nested dataset
 
 
 def get_dataset_lens(data, require_numpy=False):
+    lens = []
+    _append_dataset_lens(data, require_numpy, lens)
+    return lens
+
+
+def _append_dataset_lens(data, require_numpy, lens):
+    """Append the lengths of the leafs in `data` to `lens`
+    """
     if type(data).__module__ == 'numpy':
         if require_numpy and not data.shape:
             raise ValueError("all numpy arrays need to have at least one axis")
-        return [1] if not data.shape else [data.shape[0]]
+        lens.append(1 if not data.shape else data.shape[0])
     elif isinstance(data, int) and not require_numpy:
-        return [1]
+        lens.append(1)
     elif isinstance(data, float) and not require_numpy:
-        return [1]
+        lens.append(1)
     elif isinstance(data, string_classes) and not require_numpy:
         # Also convert to a numpy array
-        return [1]
-        # return data
+        lens.append(1)
     elif isinstance(data, collections.abc.Mapping) and not type(data).__module__ == 'numpy':
-        return sum([get_dataset_lens(data[key], require_numpy) for key in data], [])
+        for key in data:
+            _append_dataset_lens(data[key], require_numpy, lens)
     elif isinstance(data, collections.abc.Sequence) and not type(data).__module__ == 'numpy':
-        return sum([get_dataset_lens(sample, require_numpy) for sample in data], [])
+        for sample in data:
+            _append_dataset_lens(sample, require_numpy, lens)
     else:
         raise ValueError("Leafs of the nested structure need to be numpy arrays")
 
@@ -122,6 +671,141 @@ def get_dataset_item(data, idx):
         raise ValueError("Leafs of the nested structure need to be numpy arrays")
 
 
+class NestedArrayDataset(object):
+    """Dataset backed by a nested structure of numpy arrays
+
+    The nested structure (dictionaries and lists, as understood by
+    `get_dataset_item`) is compiled once into a flat list of leaf arrays, all of
+    which need to have the same length. Samples and whole batches are taken by
+    indexing the leaf arrays directly, see `get_batch` used by the DataLoader.
+
+    The dataset can be saved to a directory of `.npy` files and loaded back
+    memory-mapped (`load`). Memory-mapped datasets are pickled by their path only,
+    hence DataLoader workers re-open the same files and share them through the
+    page cache.
+
+    Args:
+      data: nested dictionaries/lists of numpy arrays with at least one axis
+    """
+
+    def __init__(self, data):
+        self.leaves = []
+        self.structure = self._compile(data)
+        lens = [len(x) for x in self.leaves]
+        if len(set(lens)) > 1:
+            raise ValueError("All numpy arrays need to have the same length. Found: {}".format(lens))
+        self.n = lens[0] if lens else 0
+        # set when loaded from disk
+        self.path = None
+        self.mmap_mode = None
+
+    def _compile(self, data):
+        """Structure of `data` with the arrays replaced by their position in `self.leaves`
+        """
+        if type(data).__module__ == 'numpy':
+            if not data.shape:
+                raise ValueError("all numpy arrays need to have at least one axis")
+            self.leaves.append(data)
+            return len(self.leaves) - 1
+        elif isinstance(data, collections.abc.Mapping):
+            return {key: self._compile(data[key]) for key in data}
+        elif isinstance(data, collections.abc.Sequence) and not isinstance(data, string_classes):
+            return [self._compile(x) for x in data]
+        else:
+            raise ValueError("Leafs of the nested structure need to be numpy arrays")
+
+    def _rebuild(self, structure, leaves):
+        if isinstance(structure, dict):
+            return {key: self._rebuild(v, leaves) for key, v in structure.items()}
+        elif isinstance(structure, list):
+            return [self._rebuild(v, leaves) for v in structure]
+        return leaves[structure]
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        return self._rebuild(self.structure, [x[idx] for x in self.leaves])
+
+    def get_batch(self, indices):
+        """Collated batch of samples `indices` (fancy-indexing of all the leaf arrays)
+        """
+        indices = np.asarray(indices)
+        return self._rebuild(self.structure, [x[indices] for x in self.leaves])
+
+    def load_all(self):
+        """Nested structure of all the arrays
+        """
+        return self._rebuild(self.structure, self.leaves)
+
+    def save(self, path):
+        """Save the dataset to the directory `path` as one `.npy` file per array
+
+        The dictionary keys of the nested structure need to be strings. Object arrays
+        of strings (or bytes) are saved as fixed-width `U` (or `S`) arrays, other
+        object arrays can't be memory-mapped and raise a ValueError.
+        """
+        leaves = [self._fixed_width(x) for x in self.leaves]
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for i, x in enumerate(leaves):
+            np.save(os.path.join(path, "{}.npy".format(i)), x)
+        with open(os.path.join(path, "structure.json"), "w") as f:
+            json.dump(self.structure, f)
+
+    @staticmethod
+    def _fixed_width(x):
+        """Convert the object array of strings or bytes `x` to a fixed-width array
+        """
+        if not x.dtype.hasobject:
+            return x
+        if x.dtype == object:
+            for string_type in (str, bytes):
+                if all(isinstance(v, string_type) for v in x.flat):
+                    return x.astype(string_type)
+        raise ValueError("Arrays of python objects can't be saved. Found an array of "
+                         "dtype {} with values of type {}".format(
+                             x.dtype, sorted({type(v).__name__ for v in x.flat})))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load the dataset saved with `save`
+
+        Args:
+          path: directory of the saved dataset
+          mmap_mode: memory-map mode passed to `np.load`. None loads the arrays into memory.
+        """
+        with open(os.path.join(path, "structure.json")) as f:
+            structure = json.load(f)
+        obj = cls.__new__(cls)
+        obj.structure = structure
+        obj.leaves = [np.load(os.path.join(path, "{}.npy".format(i)), mmap_mode=mmap_mode)
+                      for i in range(cls._num_leaves(structure))]
+        obj.n = len(obj.leaves[0]) if obj.leaves else 0
+        obj.path = path
+        obj.mmap_mode = mmap_mode
+        return obj
+
+    @classmethod
+    def _num_leaves(cls, structure):
+        if isinstance(structure, dict):
+            return sum(cls._num_leaves(v) for v in structure.values())
+        elif isinstance(structure, list):
+            return sum(cls._num_leaves(v) for v in structure)
+        return 1
+
+    def __getstate__(self):
+        if self.mmap_mode is not None:
+            # re-open the memory-mapped files instead of copying the arrays
+            return {'path': self.path, 'mmap_mode': self.mmap_mode}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'leaves' not in state:
+            state = self.load(state['path'], state['mmap_mode']).__dict__
+        self.__dict__.update(state)
+
+
 def iterable_cycle(iterable):
     """
     Args:
@@ -132,8 +816,65 @@ def iterable_cycle(iterable):
             yield x
 
 
-def flatten_batch(batch, nested_sep="/"):
-    """Convert the nested batch of numpy arrays into a dictionary of 1-dimensional numpy arrays
+def _join_key(prefix, key, nested_sep):
+    return u"{}{}{}".format(prefix, nested_sep, key) if prefix else key
+
+
+class ColumnBlock(object):
+    """Columns of a single leaf of a flattened batch
+
+    Holds the leaf array and exposes it as a 2-dimensional ``(batch, n_columns)``
+    array (`values`, a view for contiguous arrays) so that writers can consume the
+    whole block at once. The column names, e.g. ``"preds/3/1"`` for ``arr[:, 3, 1]``,
+    are only generated when accessed.
+
+    Args:
+      name: flattened name of the leaf
+      array: numpy array with the batch on the first axis
+      nested_sep: separator of the column name elements
+    """
+
+    def __init__(self, name, array, nested_sep="/"):
+        self.name = name
+        self.array = array
+        self.nested_sep = nested_sep
+        self._columns = None
+
+    @property
+    def values(self):
+        if self.array.ndim == 0:
+            return self.array.reshape((1, 1))
+        return self.array.reshape((len(self.array), -1))
+
+    @property
+    def columns(self):
+        """Names of the columns of `values`
+        """
+        if self._columns is None:
+            if self.array.ndim <= 1:
+                self._columns = [self.name]
+            else:
+                self._columns = [self.nested_sep.join([self.name] + [str(i) for i in idx])
+                                 if self.name else self.nested_sep.join(str(i) for i in idx)
+                                 for idx in np.ndindex(*self.array.shape[1:])]
+        return self._columns
+
+    def __len__(self):
+        return 1 if self.array.ndim <= 1 else int(np.prod(self.array.shape[1:]))
+
+    def to_dict(self):
+        """Dictionary of 1-dimensional column arrays (the form returned by `flatten_batch`)
+        """
+        if self.array.ndim <= 1:
+            return {self.name: self.array}
+        return collections.OrderedDict(zip(self.columns, self.values.T))
+
+
+def flatten_batch_columnar(batch, nested_sep="/"):
+    """Flatten the nested batch into one block of columns per leaf array
+
+    Unlike `flatten_batch`, the multi-dimensional arrays are not split into individual
+    columns. Pandas DataFrames give one block per column.
 
     Args:
       batch: batch of data
@@ -141,27 +882,53 @@ def flatten_batch(batch, nested_sep="/"):
           into a single key
 
     Returns:
-      A dictionary of 1-dimensional numpy arrays.
+      An ordered dictionary mapping the flattened leaf names to `ColumnBlock`s.
     """
+    blocks = collections.OrderedDict()
 
-    def array2array_dict(arr):
-        """Convert a numpy array into a dictionary of numpy arrays
-
-        >>> arr = np.arange(9).reshape((1, 3, 3))
-        >>> assert array2array_dict(arr)["0"]["1"][0] == arr[:, 0, 1][0]
-        """
-        if isinstance(arr, np.ndarray):
-            if arr.ndim <= 1:
-                return arr
-            else:
-                return collections.OrderedDict([(str(i), array2array_dict(arr[:, i]))
-                                                for i in range(arr.shape[1])])
-        elif isinstance(arr, pd.DataFrame):
-            return {k: v.values for k, v in arr.to_dict("records").items()}
-        elif (arr.__class__.__module__, arr.__class__.__name__) == ('kipoi.metadata', 'GenomicRanges'):
-            return arr.to_dict()
+    def add(name, x):
+        if isinstance(x, collections.abc.Mapping):
+            for k, v in x.items():
+                add(_join_key(name, k, nested_sep), v)
+        elif isinstance(x, list):
+            for i, v in enumerate(x):
+                add(_join_key(name, str(i), nested_sep), v)
+        elif isinstance(x, np.ndarray):
+            blocks[name] = ColumnBlock(name, x, nested_sep)
+        elif isinstance(x, pd.DataFrame):
+            for k, v in x.items():
+                key = _join_key(name, k, nested_sep)
+                blocks[key] = ColumnBlock(key, v.values, nested_sep)
+        elif (x.__class__.__module__, x.__class__.__name__) == ('kipoi.metadata', 'GenomicRanges'):
+            add(name, x.to_dict())
         else:
-            raise ValueError("Unknown data type: %s" % str(type(arr)))
+            raise ValueError("Unknown data type: %s" % str(type(x)))
+
+    add('', batch)
+    return blocks
+
+
+def columnar_to_dict(blocks):
+    """Convert the output of `flatten_batch_columnar` into the dictionary
+    of 1-dimensional numpy arrays returned by `flatten_batch`
+    """
+    out = {}
+    for block in blocks.values():
+        out.update(block.to_dict())
+    return out
+
 
-    return flatten(map_nested(batch, array2array_dict),
-                   separator=nested_sep)
+def flatten_batch(batch, nested_sep="/"):
+    """Convert the nested batch of numpy arrays into a dictionary of 1-dimensional numpy arrays
+
+    Use `flatten_batch_columnar` to process the multi-dimensional arrays as a whole.
+
+    Args:
+      batch: batch of data
+      nested_sep: What separator to use for flattening the nested dictionary structure
+          into a single key
+
+    Returns:
+      A dictionary of 1-dimensional numpy arrays.
+    """
+    return columnar_to_dict(flatten_batch_columnar(batch, nested_sep))
@@ -3,12 +3,18 @@
 As I was getting the ImportError: dlopen: cannot load any more object with static TLS
 error
 """
+import asyncio
 import multiprocessing
-from .sampler import SequentialSampler, RandomSampler, BatchSampler
+import numpy as np
+from .sampler import SequentialSampler, RandomSampler, BatchSampler, InterleavedBatchSampler
+from .shared_memory import SlabPool, SharedBatch, SharedDataset
 import collections
+import functools
 import sys
 import traceback
 import threading
+import time
+import weakref
 # TODO THIS NEEDS TO BE SOMEWHERE ELSE
 from kipoi_utils.data_utils import numpy_collate
 # string_classes
@@ -30,6 +36,13 @@ default_collate = numpy_collate
 _use_shared_memory = False
 """Whether to use shared memory in default_collate"""
 
+# number of batches per worker between two autoscaling decisions
+_AUTOSCALE_WINDOW = 4
+# fraction of the time the consumer may wait for batches before adding a worker
+_AUTOSCALE_MAX_CONSUMER_WAIT = 0.1
+# fraction of the time the workers may be idle before retiring one
+_AUTOSCALE_MAX_WORKER_IDLE = 0.5
+
 # -------
 
 
@@ -41,29 +54,113 @@ class ExceptionWrapper(object):
         self.exc_msg = "".join(traceback.format_exception(*exc_info))
 
 
-def _worker_loop(dataset, index_queue, data_queue, collate_fn):
+def _uses_aget(dataset):
+    return (hasattr(dataset, 'aget') and not hasattr(dataset, 'get_batch') and
+            not hasattr(dataset, '__getitems__'))
+
+
+async def _aget_samples(dataset, batch_indices, async_limit):
+    """Concurrently load the samples using `dataset.aget(idx)`
+
+    At most `async_limit` samples are loaded at the same time.
+    """
+    semaphore = asyncio.Semaphore(async_limit)
+
+    async def aget(idx):
+        async with semaphore:
+            return await dataset.aget(idx)
+    return await asyncio.gather(*[aget(i) for i in batch_indices])
+
+
+def _fetch_samples(dataset, batch_indices, loop=None, async_limit=None):
+    """Load the samples of a single batch from the dataset
+
+    Uses the batched access methods of the dataset if available:
+      - `dataset.get_batch(indices)` returning the already collated batch
+      - `dataset.__getitems__(indices)` returning the list of samples
+        which is then collated (same as in pytorch)
+      - `async def dataset.aget(idx)` returning a single sample. All the
+        samples of the batch are loaded concurrently in the event `loop`.
+
+    Returns:
+      tuple (samples, collated)
+    """
+    if hasattr(dataset, 'get_batch'):
+        return dataset.get_batch(batch_indices), True
+    elif hasattr(dataset, '__getitems__'):
+        return dataset.__getitems__(batch_indices), False
+    elif loop is not None and hasattr(dataset, 'aget'):
+        return loop.run_until_complete(_aget_samples(dataset, batch_indices, async_limit)), False
+    else:
+        return [dataset[i] for i in batch_indices], False
+
+
+def _fetch_batch(dataset, batch_indices, collate_fn, timing=None, loop=None, async_limit=None):
+    """Load and collate a single batch from the dataset
+
+    If `timing` is a list, the time spent loading and collating the
+    samples is appended to it.
+    """
+    start = time.time()
+    samples, collated = _fetch_samples(dataset, batch_indices, loop, async_limit)
+    fetched = time.time()
+    if not collated:
+        samples = collate_fn(samples)
+    if timing is not None:
+        timing.extend([fetched - start, time.time() - fetched])
+    return samples
+
+
+def _worker_loop(dataset, index_queue, data_queue, collate_fn, slab_pool=None, build=True,
+                 async_limit=None):
     global _use_shared_memory
     _use_shared_memory = True
 
-    if hasattr(dataset, 'build'):
+    if isinstance(dataset, SharedDataset):
+        # dataset already built in the parent process
+        dataset = dataset.load()
+    elif build and hasattr(dataset, 'build'):
         # Run the build method on the dataset
         dataset.build()
+    # event loop for loading the samples of a batch concurrently
+    loop = asyncio.new_event_loop() if _uses_aget(dataset) else None
     # torch.set_num_threads(1)
     while True:
+        start = time.time()
         r = index_queue.get()
         if r is None:
             data_queue.put(None)
+            if loop is not None:
+                loop.close()
             break
         idx, batch_indices = r
+        # [idle time, fetch time, collate time, time when sent]
+        timing = [time.time() - start]
         try:
-            samples = collate_fn([dataset[i] for i in batch_indices])
+            samples = _fetch_batch(dataset, batch_indices, collate_fn, timing, loop, async_limit)
+            if slab_pool is not None:
+                samples = slab_pool.write(samples)
         except Exception:
-            data_queue.put((idx, ExceptionWrapper(sys.exc_info())))
+            data_queue.put((idx, ExceptionWrapper(sys.exc_info()), None))
         else:
-            data_queue.put((idx, samples))
+            timing.append(time.time())
+            data_queue.put((idx, samples, timing))
+
+
+def _transform_batch(batch, slab_pool=None, pin_memory=False, transforms=()):
+    """Post-collate stage: rebuild the batch from shared memory, pin it and
+    apply the user transforms
+    """
+    if isinstance(batch, SharedBatch):
+        batch = slab_pool.read(batch)
+    if pin_memory:
+        batch = pin_memory_batch(batch)
+    for transform in transforms:
+        batch = transform(batch)
+    return batch
 
 
-def _pin_memory_loop(in_queue, out_queue, done_event):
+def _transform_loop(in_queue, out_queue, done_event, transform_fn):
     while True:
         try:
             r = in_queue.get()
@@ -72,17 +169,23 @@ def _pin_memory_loop(in_queue, out_queue, done_event):
                 return
             raise
         if r is None:
-            break
+            if done_event.is_set():
+                # pass the sentinel on to the other transform threads
+                in_queue.put(None)
+                break
+            # retired worker
+            out_queue.put(r)
+            continue
         if isinstance(r[1], ExceptionWrapper):
             out_queue.put(r)
             continue
-        idx, batch = r
+        idx, batch, timing = r
         try:
-            batch = pin_memory_batch(batch)
+            batch = transform_fn(batch)
         except Exception:
-            out_queue.put((idx, ExceptionWrapper(sys.exc_info())))
+            out_queue.put((idx, ExceptionWrapper(sys.exc_info()), timing))
         else:
-            out_queue.put((idx, batch))
+            out_queue.put((idx, batch, timing))
 
 
 def pin_memory_batch(batch):
@@ -96,51 +199,165 @@ def pin_memory_batch(batch):
         return batch
 
 
+def _batch_nbytes(batch):
+    """Total number of bytes of the numpy arrays in a (nested) batch
+    """
+    if isinstance(batch, np.ndarray):
+        return batch.nbytes
+    elif isinstance(batch, SharedBatch):
+        return batch.nbytes
+    elif isinstance(batch, collections.abc.Mapping):
+        return sum(_batch_nbytes(v) for v in batch.values())
+    elif isinstance(batch, (list, tuple)):
+        return sum(_batch_nbytes(v) for v in batch)
+    else:
+        return 0
+
+
+class LoaderStats(object):
+    """Aggregated per-stage timings of a DataLoaderIter
+
+    All the timings are in seconds and summed over the batches. Recording costs
+    a few clock reads per batch and can be left on in production.
+
+    Stages:
+      worker_idle_time: time the workers waited for new indices
+      fetch_time: time spent loading the samples from the dataset
+      collate_time: time spent in collate_fn
+      queue_time: time between sending the batch from the worker
+        and receiving it in the main process
+      consumer_wait_time: time the consumer waited for the next batch
+      consumer_time: time the consumer spent between two batches
+
+    Also keeps track of the current number of workers.
+    """
+    stages = ['worker_idle_time', 'fetch_time', 'collate_time', 'queue_time',
+              'consumer_wait_time', 'consumer_time']
+
+    def __init__(self, num_workers=0):
+        self.num_workers = num_workers
+        self.batches = 0
+        self.timings = {k: 0.0 for k in self.stages}
+        self.n_reorder_samples = 0
+        self.reorder_size_sum = 0
+        self.reorder_size_max = 0
+
+    def add_worker_timing(self, timing, rcvd_time):
+        idle_time, fetch_time, collate_time, sent_time = timing
+        self.timings['worker_idle_time'] += idle_time
+        self.timings['fetch_time'] += fetch_time
+        self.timings['collate_time'] += collate_time
+        self.timings['queue_time'] += max(rcvd_time - sent_time, 0)
+
+    def add_reorder_size(self, size):
+        self.n_reorder_samples += 1
+        self.reorder_size_sum += size
+        self.reorder_size_max = max(self.reorder_size_max, size)
+
+    def snapshot(self):
+        """Current statistics as a dictionary
+        """
+        out = {"batches": self.batches, "num_workers": self.num_workers}
+        out.update(self.timings)
+        out['reorder_size_mean'] = (self.reorder_size_sum / self.n_reorder_samples
+                                    if self.n_reorder_samples else 0.0)
+        out['reorder_size_max'] = self.reorder_size_max
+        return out
+
+
 class DataLoaderIter(object):
-    "Iterates once over the DataLoader's dataset, as specified by the sampler"
+    """Iterates once over the DataLoader's dataset, as specified by the sampler
+
+    With ``persistent_workers``, the iterator is re-used across epochs by calling `_reset`.
+
+    The progress within the epoch is tracked in terms of batch positions in the
+    batch sampler iteration: `state_dict` records the batches delivered so far and
+    the iteration is resumed by skipping them (see `_start_sampler`).
+    """
 
     def __init__(self, loader):
         self.dataset = loader.dataset
         self.collate_fn = loader.collate_fn
         self.batch_sampler = loader.batch_sampler
         self.num_workers = loader.num_workers
+        self.worker_backend = loader.worker_backend
         self.pin_memory = loader.pin_memory
+        self.persistent_workers = loader.persistent_workers
+        self.prefetch_factor = loader.prefetch_factor
+        self.in_order = loader.in_order
+        self.max_inflight_bytes = loader.max_inflight_bytes
+        self.async_limit = loader.async_limit
+        self.transforms = list(loader.transforms or [])
+        self.slab_pool = None
+        self.shared_dataset = None
         self.done_event = threading.Event()
+        self.stats_counter = LoaderStats(self.num_workers)
+        # time when the last batch was returned to the consumer
+        self.last_return_time = None
 
-        self.sample_iter = iter(self.batch_sampler)
+        self._start_sampler(loader._resume_state)
 
         if self.num_workers > 0:
-            self.index_queue = SimpleQueue()
-            self.data_queue = SimpleQueue()
             self.batches_outstanding = 0
             self.shutdown = False
             self.send_idx = 0
-            self.rcvd_idx = 0
-            self.reorder_dict = {}
+            # size statistics of the received batches
+            self.n_rcvd_batches = 0
+            self.rcvd_bytes = 0
 
-            self.workers = [
-                multiprocessing.Process(
-                    target=_worker_loop,
-                    args=(self.dataset, self.index_queue, self.data_queue, self.collate_fn))
-                for _ in range(self.num_workers)]
+            # autoscaling
+            self.min_workers = loader.min_workers or self.num_workers
+            self.max_workers = loader.max_workers or self.num_workers
+            self.autoscale_start = None
+
+            if self.worker_backend == 'thread':
+                # the threads share the dataset, hence build it only once
+                if hasattr(self.dataset, 'build'):
+                    self.dataset.build()
+                self.index_queue = queue.Queue()
+                self.data_queue = queue.Queue()
+                self.worker_args = (self.dataset, self.index_queue, self.data_queue,
+                                    self.collate_fn, None, False, self.async_limit)
+            else:
+                self.index_queue = SimpleQueue()
+                self.data_queue = SimpleQueue()
+                if loader.shared_memory:
+                    # one slab per outstanding batch plus a few held by the consumer
+                    self.slab_pool = SlabPool(self.prefetch_factor * self.max_workers + 2,
+                                              loader.shared_memory_slab_size)
+                if loader.share_dataset:
+                    # build once and share the arrays with the workers
+                    if hasattr(self.dataset, 'build'):
+                        self.dataset.build()
+                    self.shared_dataset = SharedDataset(self.dataset)
+                self.worker_args = (self.shared_dataset or self.dataset, self.index_queue,
+                                    self.data_queue, self.collate_fn, self.slab_pool, True,
+                                    self.async_limit)
 
-            for w in self.workers:
-                w.daemon = True  # ensure that the worker exits on process exit
-                w.start()
+            self.workers = []
+            for _ in range(self.num_workers):
+                self._start_worker()
 
-            if self.pin_memory:
+            if self.pin_memory or self.transforms:
+                # post-collate stage running in background threads
                 in_data = self.data_queue
                 self.data_queue = queue.Queue()
-                self.pin_thread = threading.Thread(
-                    target=_pin_memory_loop,
-                    args=(in_data, self.data_queue, self.done_event))
-                self.pin_thread.daemon = True
-                self.pin_thread.start()
-
-            # prime the prefetch loop
-            for _ in range(2 * self.num_workers):
-                self._put_indices()
+                transform_fn = functools.partial(_transform_batch, slab_pool=self.slab_pool,
+                                                 pin_memory=self.pin_memory,
+                                                 transforms=self.transforms)
+                self.transform_threads = [
+                    threading.Thread(
+                        target=_transform_loop,
+                        args=(in_data, self.data_queue, self.done_event, transform_fn))
+                    for _ in range(loader.transform_workers)]
+                for t in self.transform_threads:
+                    t.daemon = True
+                    t.start()
+
+            self._reset(loader, first_iter=True)
         else:
+            self.rcvd_idx = 0
+            self.aget_loop = None
             if hasattr(self.dataset, 'build'):
                 # Run the build method for the dataset
                 self.dataset.build()
@@ -148,53 +365,365 @@ class DataLoaderIter(object):
     def __len__(self):
         return len(self.batch_sampler)
 
+    def _start_worker(self):
+        if self.worker_backend == 'thread':
+            w = threading.Thread(target=_worker_loop, args=self.worker_args)
+        else:
+            w = multiprocessing.Process(target=_worker_loop, args=self.worker_args)
+        w.daemon = True  # ensure that the worker exits on process exit
+        w.start()
+        self.workers.append(w)
+
+    def _autoscale(self):
+        """Add or retire a worker based on the statistics since the last decision
+
+        A worker is added if the consumer spends a large fraction of the time waiting
+        for batches while the workers are busy and retired if the workers are mostly
+        idle while the consumer never waits.
+        """
+        timings = self.stats_counter.timings
+        now = time.time()
+        if self.autoscale_start is None:
+            self.autoscale_start = (now, self.stats_counter.batches, dict(timings))
+            return
+        start, start_batches, start_timings = self.autoscale_start
+        if self.stats_counter.batches - start_batches < _AUTOSCALE_WINDOW * self.num_workers:
+            return
+        elapsed = max(now - start, 1e-9)
+        consumer_wait = (timings['consumer_wait_time'] - start_timings['consumer_wait_time']) / elapsed
+        worker_idle = ((timings['worker_idle_time'] - start_timings['worker_idle_time']) /
+                       (elapsed * self.num_workers))
+        if (consumer_wait > _AUTOSCALE_MAX_CONSUMER_WAIT and worker_idle < _AUTOSCALE_MAX_WORKER_IDLE and
+                self.num_workers < self.max_workers):
+            self.num_workers += 1
+            self.stats_counter.num_workers = self.num_workers
+            self.workers = [w for w in self.workers if w.is_alive()]
+            self._start_worker()
+            self._fill_prefetch()
+        elif (worker_idle > _AUTOSCALE_MAX_WORKER_IDLE and consumer_wait < _AUTOSCALE_MAX_CONSUMER_WAIT and
+              self.num_workers > self.min_workers):
+            # the first worker getting it after the already queued indices exits
+            self.num_workers -= 1
+            self.stats_counter.num_workers = self.num_workers
+            self.index_queue.put(None)
+        self.autoscale_start = (now, self.stats_counter.batches, dict(timings))
+
+    def _start_sampler(self, state=None):
+        """Start the iteration over the batch sampler, resuming it from `state` if given
+        """
+        # batch positions delivered to the consumer: all below `num_delivered`
+        # and the ones in `delivered` (delivered out of order)
+        self.num_delivered = 0
+        self.delivered = set()
+        # indices of the batches requested from the workers but not yet delivered
+        self.task_indices = {}
+        if state is not None:
+            if hasattr(self.batch_sampler, 'load_state_dict'):
+                self.batch_sampler.load_state_dict(state['batch_sampler'])
+            if state['num_delivered'] >= len(self.batch_sampler):
+                # the saved epoch was complete: move on to the next one
+                iter(self.batch_sampler)
+            else:
+                self.num_delivered = state['num_delivered']
+                self.delivered = set(state['delivered'])
+        self.sample_iter = iter(self.batch_sampler)
+        # state of the batch sampler needed to reproduce this iteration
+        if hasattr(self.batch_sampler, 'state_dict'):
+            self.sampler_state = self.batch_sampler.state_dict()
+        else:
+            self.sampler_state = {}
+
+    def _is_delivered(self, batch_idx):
+        return batch_idx < self.num_delivered or batch_idx in self.delivered
+
+    def _mark_delivered(self, batch_idx):
+        self.delivered.add(batch_idx)
+        while self.num_delivered in self.delivered:
+            self.delivered.remove(self.num_delivered)
+            self.num_delivered += 1
+
+    def state_dict(self):
+        """State of the iteration. Pass it to `DataLoader.load_state_dict` to
+        continue the iteration with a new DataLoader after a restart
+
+        Returns:
+          dict with keys:
+            - batch_sampler: state of the batch sampler reproducing the iteration order
+            - num_delivered: number of batches delivered in order
+            - delivered: positions of the other batches delivered out of order
+            - outstanding: indices of the batches requested but not yet delivered
+              keyed by batch position. They get loaded again when resuming.
+        """
+        epoch_start_idx = getattr(self, 'epoch_start_idx', 0)
+        return {'batch_sampler': self.sampler_state,
+                'num_delivered': self.num_delivered,
+                'delivered': sorted(self.delivered),
+                'outstanding': {idx - epoch_start_idx: list(indices)
+                                for idx, indices in self.task_indices.items()
+                                if idx >= epoch_start_idx}}
+
+    def load_state_dict(self, state_dict):
+        """Restart the epoch from a state returned by `state_dict`
+        """
+        if self.num_workers == 0:
+            self._start_sampler(state_dict)
+            self.rcvd_idx = 0
+        else:
+            if self.shutdown:
+                raise RuntimeError("the workers of the iterator have already been shut down")
+            self._start_sampler(state_dict)
+            self._start_epoch()
+
+    def _reset(self, loader, first_iter=False):
+        """Start a new epoch with the running workers
+        """
+        if not first_iter:
+            self.batch_sampler = loader.batch_sampler
+            self._start_sampler(loader._resume_state)
+        self._start_epoch()
+
+    def _start_epoch(self):
+        self.sampler_exhausted = False
+        self.last_return_time = None
+        # batches of an interrupted previous epoch still in flight get dropped
+        self.epoch_start_idx = self.send_idx
+        self.rcvd_idx = self.send_idx
+        for batch in getattr(self, 'reorder_dict', {}).values():
+            self._discard_batch(batch)
+        self.reorder_dict = {}
+        self.reorder_bytes = 0
+
+        # prime the prefetch loop
+        self._fill_prefetch()
+
+    @property
+    def inflight_bytes(self):
+        """Number of bytes of the batches requested from the workers but not yet returned
+
+        Exact for the batches already received and waiting in the reorder buffer
+        and estimated from the average batch size for the batches still being loaded.
+        """
+        if self.num_workers == 0:
+            return 0
+        if self.n_rcvd_batches:
+            outstanding_bytes = self.batches_outstanding * self.rcvd_bytes // self.n_rcvd_batches
+        else:
+            outstanding_bytes = 0
+        return self.reorder_bytes + outstanding_bytes
+
+    def _fill_prefetch(self):
+        """Request new batches from the workers until the prefetch limits are reached
+        """
+        while not self.sampler_exhausted:
+            if (self.batches_outstanding + len(self.reorder_dict) >=
+                    self.prefetch_factor * self.num_workers):
+                break
+            # always keep one batch in flight to guarantee progress
+            if self.max_inflight_bytes is not None and self.batches_outstanding > 0:
+                if self.n_rcvd_batches == 0:
+                    # batch size unknown: request at most one batch per worker
+                    if self.batches_outstanding >= self.num_workers:
+                        break
+                elif self.inflight_bytes >= self.max_inflight_bytes:
+                    break
+            self._put_indices()
+
     def __next__(self):
-        if self.num_workers == 0:  # same-process loading
-            indices = next(self.sample_iter)  # may raise StopIteration
-            batch = self.collate_fn([self.dataset[i] for i in indices])
-            if self.pin_memory:
-                batch = pin_memory_batch(batch)
-            return batch
+        start = time.time()
+        if self.last_return_time is not None:
+            self.stats_counter.timings['consumer_time'] += start - self.last_return_time
+        batch = self._next_batch(block=True)
+        self.last_return_time = time.time()
+        self.stats_counter.timings['consumer_wait_time'] += self.last_return_time - start
+        self.stats_counter.batches += 1
+        return batch
 
-        # check if the next sample has already been generated
-        if self.rcvd_idx in self.reorder_dict:
-            batch = self.reorder_dict.pop(self.rcvd_idx)
-            return self._process_next_batch(batch)
+    def stats(self):
+        """Snapshot of the loading statistics (see `LoaderStats`)
+        """
+        out = self.stats_counter.snapshot()
+        out['inflight_bytes'] = self.inflight_bytes
+        return out
 
-        if self.batches_outstanding == 0:
-            self._shutdown_workers()
-            raise StopIteration
+    def _next_batch(self, block):
+        """Get the next batch
+
+        Raises `queue.Empty` if ``block=False`` and no batch is ready yet.
+        """
+        if self.num_workers == 0:  # same-process loading
+            indices = self._next_same_process_indices()  # may raise StopIteration
+            if self.aget_loop is None and _uses_aget(self.dataset):
+                self.aget_loop = asyncio.new_event_loop()
+            timing = []
+            batch = _fetch_batch(self.dataset, indices, self.collate_fn, timing,
+                                 self.aget_loop, self.async_limit)
+            return self._process_same_process_batch(batch, timing)
 
         while True:
+            if self.in_order:
+                # skip the batches delivered before the iteration was resumed
+                while (self.rcvd_idx < self.send_idx and
+                       self._is_delivered(self.rcvd_idx - self.epoch_start_idx)):
+                    self.rcvd_idx += 1
+            # check if the next sample has already been generated
+            if self.rcvd_idx in self.reorder_dict:
+                batch = self.reorder_dict.pop(self.rcvd_idx)
+                self.reorder_bytes -= _batch_nbytes(batch)
+                return self._process_next_batch(self.rcvd_idx, batch)
+
+            if self.rcvd_idx == self.send_idx and self.sampler_exhausted:
+                if not self.persistent_workers:
+                    self._shutdown_workers()
+                raise StopIteration
+
             assert (not self.shutdown and self.batches_outstanding > 0)
-            idx, batch = self.data_queue.get()
+            if not block and self.data_queue.empty():
+                raise queue.Empty
+            r = self.data_queue.get()
+            if r is None:
+                # retired worker exited
+                continue
+            idx, batch, timing = r
             self.batches_outstanding -= 1
-            if idx != self.rcvd_idx:
+            if idx < self.epoch_start_idx:
+                # stale batch from an interrupted epoch
+                self.task_indices.pop(idx, None)
+                self._discard_batch(batch)
+                self._fill_prefetch()
+                continue
+            self._poll_interval = 0.0005
+            if timing is not None:
+                self.stats_counter.add_worker_timing(timing, time.time())
+            self.stats_counter.add_reorder_size(len(self.reorder_dict))
+            nbytes = _batch_nbytes(batch)
+            self.n_rcvd_batches += 1
+            self.rcvd_bytes += nbytes
+            if self.in_order and idx != self.rcvd_idx:
                 # store out-of-order samples
                 self.reorder_dict[idx] = batch
+                self.reorder_bytes += nbytes
                 continue
-            return self._process_next_batch(batch)
+            return self._process_next_batch(idx, batch)
 
     next = __next__  # Python 2 compatibility
 
     def __iter__(self):
         return self
 
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Get the next batch without blocking the event loop while waiting for the workers
+
+        Note: with ``num_workers=0`` the batch is loaded in the event loop thread.
+        """
+        if self.num_workers == 0 and _uses_aget(self.dataset):
+            # load the samples concurrently in the running event loop
+            try:
+                indices = self._next_same_process_indices()
+            except StopIteration:
+                raise StopAsyncIteration
+            start = time.time()
+            samples = await _aget_samples(self.dataset, indices, self.async_limit)
+            fetched = time.time()
+            batch = self.collate_fn(samples)
+            self.stats_counter.batches += 1
+            return self._process_same_process_batch(batch, [fetched - start, time.time() - fetched])
+
+        while True:
+            try:
+                batch = self._next_batch(block=False)
+            except StopIteration:
+                raise StopAsyncIteration
+            except queue.Empty:
+                start = time.time()
+                await self._wait_for_data()
+                self.stats_counter.timings['consumer_wait_time'] += time.time() - start
+            else:
+                self.stats_counter.batches += 1
+                return batch
+
+    async def _wait_for_data(self):
+        loop = asyncio.get_event_loop()
+        reader = getattr(self.data_queue, '_reader', None)
+        if reader is not None:
+            # multiprocessing queue: get notified once the pipe becomes readable
+            fut = loop.create_future()
+            try:
+                loop.add_reader(reader.fileno(), fut.set_result, None)
+            except NotImplementedError:
+                # event loop without add_reader support (e.g. ProactorEventLoop on Windows)
+                pass
+            else:
+                try:
+                    await fut
+                finally:
+                    loop.remove_reader(reader.fileno())
+                return
+        # thread-safe queue: poll with an exponential back-off
+        self._poll_interval = min(2 * getattr(self, '_poll_interval', 0.0005), 0.01)
+        await asyncio.sleep(self._poll_interval)
+
+    def _next_same_process_indices(self):
+        while True:
+            indices = next(self.sample_iter)  # may raise StopIteration
+            if not self._is_delivered(self.rcvd_idx):
+                return indices
+            # delivered before the iteration was resumed
+            self.rcvd_idx += 1
+
     def _put_indices(self):
-        assert self.batches_outstanding < 2 * self.num_workers
-        indices = next(self.sample_iter, None)
-        if indices is None:
-            return
+        assert (self.batches_outstanding + len(self.reorder_dict) <
+                self.prefetch_factor * self.num_workers)
+        while True:
+            indices = next(self.sample_iter, None)
+            if indices is None:
+                self.sampler_exhausted = True
+                return
+            if not self._is_delivered(self.send_idx - self.epoch_start_idx):
+                break
+            # delivered before the iteration was resumed
+            self.send_idx += 1
+            if not self.in_order:
+                self.rcvd_idx += 1
         self.index_queue.put((self.send_idx, indices))
+        self.task_indices[self.send_idx] = indices
         self.batches_outstanding += 1
         self.send_idx += 1
 
-    def _process_next_batch(self, batch):
+    def _process_same_process_batch(self, batch, timing):
+        self.stats_counter.timings['fetch_time'] += timing[0]
+        self.stats_counter.timings['collate_time'] += timing[1]
+        batch = _transform_batch(batch, pin_memory=self.pin_memory, transforms=self.transforms)
         self.rcvd_idx += 1
-        self._put_indices()
+        self._mark_delivered(self.rcvd_idx - 1)
+        return self._output(self.rcvd_idx - 1, batch)
+
+    def _process_next_batch(self, idx, batch):
+        # without in_order, rcvd_idx counts the batches received in the epoch
+        self.rcvd_idx += 1
+        if self.min_workers != self.max_workers:
+            self._autoscale()
+        self._fill_prefetch()
         if isinstance(batch, ExceptionWrapper):
             raise batch.exc_type(batch.exc_msg)
-        return batch
+        if isinstance(batch, SharedBatch):
+            batch = self.slab_pool.read(batch)
+        del self.task_indices[idx]
+        self._mark_delivered(idx - self.epoch_start_idx)
+        return self._output(idx - self.epoch_start_idx, batch)
+
+    def _output(self, batch_idx, batch):
+        """Format the batch returned to the consumer
+        """
+        if self.in_order:
+            return batch
+        return batch_idx, batch
+
+    def _discard_batch(self, batch):
+        if isinstance(batch, SharedBatch):
+            self.slab_pool.discard(batch)
 
     def __getstate__(self):
         # TODO: add limited pickling support for sharing an iterator
@@ -208,12 +737,18 @@ class DataLoaderIter(object):
         if not self.shutdown:
             self.shutdown = True
             self.done_event.set()
-            for _ in self.workers:
+            for _ in range(self.num_workers):
                 self.index_queue.put(None)
+            if self.slab_pool is not None:
+                self.slab_pool.close()
+            if self.shared_dataset is not None:
+                self.shared_dataset.close()
 
     def __del__(self):
         if self.num_workers > 0:
             self._shutdown_workers()
+        elif getattr(self, 'aget_loop', None) is not None:
+            self.aget_loop.close()
 
 
 class DataLoader(object):
@@ -222,7 +757,14 @@ class DataLoader(object):
     single- or multi-process iterators over the dataset.
 
     Arguments:
-        dataset (Dataset): dataset from which to load the data.
+        dataset (Dataset): dataset from which to load the data. If the dataset implements
+            ``get_batch(indices)``, whole batches are loaded with a single call returning
+            the already collated batch (``collate_fn`` is not used). Otherwise, if it
+            implements ``__getitems__(indices)`` returning a list of samples, the list
+            gets collated. If it implements the coroutine ``async def aget(idx)``,
+            all the samples of a batch are loaded concurrently using an event loop
+            in each worker. By default, the samples are loaded one by one with
+            ``dataset[i]`` and collated.
         batch_size (int, optional): how many samples per batch to load
             (default: 1).
         shuffle (bool, optional): set to ``True`` to have the data reshuffled
@@ -238,20 +780,116 @@ class DataLoader(object):
         collate_fn (callable, optional): merges a list of samples to form a mini-batch.
         pin_memory (bool, optional): If ``True``, the data loader will copy tensors
             into CUDA pinned memory before returning them.
+        transforms (list of callables, optional): functions applied to each collated
+            batch before returning it: ``batch = transform(batch)``. With
+            ``num_workers > 0`` they run in a pool of ``transform_workers`` background
+            threads so that the consuming thread stays free. See e.g.
+            `kipoi_utils.data_utils.cast_transform` (default: None).
+        transform_workers (int, optional): number of threads running the
+            ``transforms`` (default: 1).
         drop_last (bool, optional): set to ``True`` to drop the last incomplete batch,
             if the dataset size is not divisible by the batch size. If False and
             the size of dataset is not divisible by the batch size, then the last batch
             will be smaller. (default: False)
+        persistent_workers (bool, optional): If ``True``, the workers (and their built
+            datasets) are kept alive after the dataset has been consumed once and
+            re-used for the next epoch. Requires ``num_workers > 0`` (default: False).
+        prefetch_factor (int, optional): number of batches loaded in advance
+            by each worker (default: 2).
+        min_workers (int, optional): If set together with ``max_workers``, the number of
+            workers is adapted while loading the data. Starting with ``num_workers``,
+            a worker is added when the consumer waits for the batches while the workers
+            are busy and retired when the workers are mostly idle. The current number of
+            workers is reported in ``stats()`` (default: None).
+        max_workers (int, optional): maximal number of workers when autoscaling
+            (default: None).
+        in_order (bool, optional): If ``False``, batches are returned as soon as any
+            worker has loaded them instead of in the order of the sampler, and each
+            batch is returned as a ``(batch_idx, batch)`` tuple where ``batch_idx``
+            is the position of the batch in the sampler order (default: True).
+        max_inflight_bytes (int, optional): If set, no new batches are requested from
+            the workers while the batches loaded in advance (see
+            ``DataLoaderIter.inflight_bytes``) take up at least this many bytes.
+            Bounds the memory used by prefetching batches of variable size
+            (default: None).
+        async_limit (int, optional): maximal number of samples loaded concurrently
+            with ``dataset.aget`` by a single worker (default: 32).
+        shared_memory (bool, optional): If ``True``, workers write the numpy arrays of
+            each collated batch into a pool of reusable shared-memory slabs and the
+            returned batches are zero-copy views into these slabs. A slab is reused
+            once all arrays of its batch have been garbage-collected, so copy the
+            arrays if you want to keep them around. Only used with
+            ``num_workers > 0`` (default: False).
+        shared_memory_slab_size (int, optional): size of a single shared-memory slab
+            in bytes. Batches larger than this are transferred by pickling
+            (default: 64MB).
+        share_dataset (bool, optional): If ``True``, ``dataset.build()`` is called only
+            once in the main process and the large numpy arrays of the built dataset
+            (including the ones held by pandas objects) are moved to shared memory.
+            Each worker then unpickles the dataset attached read-only to these arrays
+            instead of building it again. The built dataset needs to be picklable,
+            so open file handles should be (re-)opened lazily in the workers. Has no
+            effect with ``worker_backend='thread'`` (default: False).
+        worker_backend (str, optional): ``'process'`` to load the data in
+            ``num_workers`` subprocesses or ``'thread'`` to load it in a pool of
+            ``num_workers`` threads sharing the dataset. Threads avoid forking and
+            pickling the batches and are the better choice for datasets spending
+            most of their time in code releasing the GIL (file I/O, numpy).
+            With ``'thread'``, ``dataset.build()`` is called only once
+            (default: 'process').
     """
 
+    iterator_class = DataLoaderIter
+
     def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
-                 num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False):
+                 num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False,
+                 transforms=None, transform_workers=1,
+                 persistent_workers=False, prefetch_factor=2, min_workers=None, max_workers=None,
+                 in_order=True, max_inflight_bytes=None, async_limit=32,
+                 shared_memory=False, shared_memory_slab_size=64 * 2**20, share_dataset=False,
+                 worker_backend='process'):
         self.dataset = dataset
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.worker_backend = worker_backend
         self.collate_fn = collate_fn
         self.pin_memory = pin_memory
         self.drop_last = drop_last
+        self.transforms = transforms
+        self.transform_workers = transform_workers
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.in_order = in_order
+        self.max_inflight_bytes = max_inflight_bytes
+        self.async_limit = async_limit
+        self._iterator = None
+        self._last_iterator = None
+        self._last_stats = LoaderStats(num_workers)
+        # state from which the next iteration is resumed (see `load_state_dict`)
+        self._resume_state = None
+        self.shared_memory = shared_memory
+        self.shared_memory_slab_size = shared_memory_slab_size
+        self.share_dataset = share_dataset
+
+        if worker_backend not in ('process', 'thread'):
+            raise ValueError("worker_backend needs to be 'process' or 'thread'")
+
+        if persistent_workers and num_workers == 0:
+            raise ValueError('persistent_workers option needs num_workers > 0')
+
+        if (min_workers is None) != (max_workers is None):
+            raise ValueError('min_workers and max_workers need to be specified together')
+
+        if min_workers is not None and not 0 < min_workers <= num_workers <= max_workers:
+            raise ValueError('autoscaling requires 0 < min_workers <= num_workers <= max_workers')
+
+        if prefetch_factor < 1:
+            raise ValueError('prefetch_factor needs to be at least 1')
+
+        if shared_memory and worker_backend != 'process':
+            raise ValueError("shared_memory is only supported with worker_backend='process'")
 
         if batch_sampler is not None:
             if batch_size > 1 or shuffle or sampler is not None or drop_last:
@@ -273,7 +911,180 @@ class DataLoader(object):
         self.batch_sampler = batch_sampler
 
     def __iter__(self):
-        return DataLoaderIter(self)
+        if self.persistent_workers:
+            if self._iterator is None:
+                self._iterator = self.iterator_class(self)
+            else:
+                self._iterator._reset(self)
+            it = self._iterator
+        else:
+            it = self.iterator_class(self)
+        self._resume_state = None
+        self._last_iterator = weakref.ref(it)
+        self._last_stats = it.stats_counter
+        return it
+
+    def state_dict(self):
+        """State of the current iteration over the DataLoader (see `DataLoaderIter.state_dict`)
+
+        Save it together with the model checkpoint and pass it to `load_state_dict` of
+        the same DataLoader after a restart to continue the iteration exactly where it
+        stopped, without loading the delivered batches again. The iterator needs to be
+        alive; once it has been garbage-collected, the epoch is considered complete.
+        """
+        if self._resume_state is not None:
+            return self._resume_state
+        it = self._last_iterator() if self._last_iterator is not None else None
+        if it is not None:
+            return it.state_dict()
+        state = {'batch_sampler': (self.batch_sampler.state_dict()
+                                   if hasattr(self.batch_sampler, 'state_dict') else {}),
+                 'num_delivered': 0, 'delivered': [], 'outstanding': {}}
+        if self._last_iterator is not None:
+            # the last iteration was complete
+            state['num_delivered'] = len(self.batch_sampler)
+        return state
+
+    def load_state_dict(self, state_dict):
+        """Resume the next iteration over the DataLoader from a state returned by `state_dict`
+        """
+        self._resume_state = state_dict
+
+    def stats(self):
+        """Loading statistics of the last iteration over the DataLoader
+
+        Returns:
+          dict: see `LoaderStats` for the description of the timings
+        """
+        it = self._last_iterator() if self._last_iterator is not None else None
+        if it is not None:
+            return it.stats()
+        out = self._last_stats.snapshot()
+        out['inflight_bytes'] = 0
+        return out
 
     def __len__(self):
         return len(self.batch_sampler)
+
+    def __aiter__(self):
+        """Asynchronous iteration: ``async for batch in loader``
+        """
+        return iter(self)
+
+
+class _MultiDataset(object):
+    """Dataset indexed by ``(dataset_idx, idx)`` tuples combining multiple datasets
+
+    Each batch is loaded from a single dataset and returned as
+    ``(dataset_idx, batch)``.
+    """
+
+    def __init__(self, datasets, collate_fn, async_limit=None):
+        self.datasets = datasets
+        self.collate_fn = collate_fn
+        self.async_limit = async_limit
+
+    def build(self):
+        for dataset in self.datasets:
+            if hasattr(dataset, 'build'):
+                dataset.build()
+
+    def __len__(self):
+        return sum(len(dataset) for dataset in self.datasets)
+
+    def get_batch(self, keys):
+        dataset_idx = keys[0][0]
+        dataset = self.datasets[dataset_idx]
+        indices = [idx for _, idx in keys]
+        # the worker threads share the _MultiDataset, hence use one event loop per batch.
+        # No new loop if the batch is loaded inside a running loop (async iteration)
+        if _uses_aget(dataset) and asyncio._get_running_loop() is None:
+            loop = asyncio.new_event_loop()
+            try:
+                batch = _fetch_batch(dataset, indices, self.collate_fn, None, loop,
+                                     self.async_limit)
+            finally:
+                loop.close()
+        else:
+            batch = _fetch_batch(dataset, indices, self.collate_fn)
+        return dataset_idx, batch
+
+
+def _tagged_transform(transform, tagged_batch):
+    dataset_idx, batch = tagged_batch
+    return dataset_idx, transform(batch)
+
+
+class _InterleavedDataLoaderIter(DataLoaderIter):
+
+    def __init__(self, loader):
+        self.names = loader.names
+        super(_InterleavedDataLoaderIter, self).__init__(loader)
+
+    def _output(self, batch_idx, batch):
+        dataset_idx, batch = batch
+        return self.names[dataset_idx], batch
+
+
+class InterleavedDataLoader(DataLoader):
+    """
+    Data loader interleaving the batches of several datasets through a single
+    worker pool. Each batch contains samples from a single dataset and is returned
+    as a ``(dataset_name, batch)`` tuple.
+
+    Arguments:
+        datasets (list or dict): datasets from which to load the data. If a
+            dictionary is given, the keys are used as dataset names, otherwise
+            the position in the list.
+        policy (str, optional): order in which the batches of the datasets are
+            interleaved. ``'round_robin'`` takes one batch from each dataset in turn,
+            ``'weighted'`` draws the dataset of each batch at random with probabilities
+            proportional to ``weights`` and ``'as_ready'`` returns the batches in the
+            order they were loaded by the workers (default: 'round_robin').
+        weights (list or dict, optional): sampling weights of the datasets
+            for ``policy='weighted'``
+        batch_size (int, optional): how many samples per batch to load (default: 1).
+        shuffle (bool, optional): set to ``True`` to shuffle the samples of each
+            dataset (default: False).
+        drop_last (bool, optional): set to ``True`` to drop the last incomplete batch
+            of each dataset (default: False).
+        collate_fn (callable, optional): merges a list of samples to form a mini-batch.
+        seed (int, optional): random seed for ``policy='weighted'``
+        **kwargs: other arguments of `DataLoader` (e.g. ``num_workers``)
+    """
+
+    iterator_class = _InterleavedDataLoaderIter
+
+    def __init__(self, datasets, policy='round_robin', weights=None, batch_size=1, shuffle=False,
+                 drop_last=False, collate_fn=default_collate, seed=None, **kwargs):
+        if policy not in ('round_robin', 'weighted', 'as_ready'):
+            raise ValueError("policy needs to be 'round_robin', 'weighted' or 'as_ready'")
+        if 'in_order' in kwargs:
+            raise ValueError("in_order is determined by the policy")
+        if isinstance(datasets, collections.abc.Mapping):
+            self.names = list(datasets)
+            datasets = [datasets[k] for k in self.names]
+            if isinstance(weights, collections.abc.Mapping):
+                weights = [weights[k] for k in self.names]
+        else:
+            self.names = list(range(len(datasets)))
+            datasets = list(datasets)
+        self.datasets = datasets
+        self.policy = policy
+
+        batch_samplers = [BatchSampler(RandomSampler(d) if shuffle else SequentialSampler(d),
+                                       batch_size, drop_last)
+                          for d in datasets]
+        batch_sampler = InterleavedBatchSampler(batch_samplers,
+                                                'weighted' if policy == 'weighted' else 'round_robin',
+                                                weights=weights, seed=seed)
+        if kwargs.get('transforms'):
+            kwargs['transforms'] = [functools.partial(_tagged_transform, t)
+                                    for t in kwargs['transforms']]
+        super(InterleavedDataLoader, self).__init__(_MultiDataset(datasets, collate_fn),
+                                                    batch_sampler=batch_sampler,
+                                                    in_order=policy != 'as_ready',
+                                                    **kwargs)
+        self.dataset.async_limit = self.async_limit
+        self.batch_size = batch_size
+        self.drop_last = drop_last
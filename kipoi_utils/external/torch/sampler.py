@@ -17,6 +17,48 @@ class Sampler(object):
     def __len__(self):
         raise NotImplementedError
 
+    def state_dict(self):
+        """State required to reproduce the current iteration (see `load_state_dict`)
+        """
+        return {}
+
+    def load_state_dict(self, state_dict):
+        """Make the next iteration reproduce the iteration the state was saved in
+        """
+        pass
+
+
+class _IterSeedMixin(object):
+    """Draws a new random seed at the beginning of each iteration
+
+    Storing the seed is enough to reproduce the iteration.
+    """
+
+    def _init_seed(self, seed):
+        self.seed = seed
+        self.rng = np.random.RandomState(seed) if seed is not None else np.random
+        self.iter_seed = None
+        self.resume_seed = None
+
+    def _iter_rng(self):
+        """Random number generator of a new iteration
+        """
+        if self.resume_seed is not None:
+            self.iter_seed, self.resume_seed = self.resume_seed, None
+        else:
+            self.iter_seed = int(self.rng.randint(2**31 - 1))
+        return np.random.RandomState(self.iter_seed)
+
+    def state_dict(self):
+        return {'iter_seed': self.iter_seed,
+                # seeds of the following iterations
+                'rng_state': self.rng.get_state() if self.seed is not None else None}
+
+    def load_state_dict(self, state_dict):
+        self.resume_seed = state_dict['iter_seed']
+        if state_dict['rng_state'] is not None:
+            self.rng.set_state(state_dict['rng_state'])
+
 
 class SequentialSampler(Sampler):
     """Samples elements sequentially, always in the same order.
@@ -34,38 +76,385 @@ class SequentialSampler(Sampler):
         return len(self.data_source)
 
 
-class RandomSampler(Sampler):
+class RandomSampler(_IterSeedMixin, Sampler):
     """Samples elements randomly, without replacement.
     Arguments:
         data_source (Dataset): dataset to sample from
+        seed (int, optional): random seed. If None, the global numpy random state is used.
     """
 
-    def __init__(self, data_source):
+    def __init__(self, data_source, seed=None):
         self.data_source = data_source
+        self._init_seed(seed)
 
     def __iter__(self):
-        return iter(np.random.permutation(len(self.data_source)))
+        return iter(self._iter_rng().permutation(len(self.data_source)))
 
     def __len__(self):
         return len(self.data_source)
 
 
-class SubsetRandomSampler(Sampler):
+class SubsetRandomSampler(_IterSeedMixin, Sampler):
     """Samples elements randomly from a given list of indices, without replacement.
     Arguments:
         indices (list): a list of indices
+        seed (int, optional): random seed. If None, the global numpy random state is used.
     """
 
-    def __init__(self, indices):
+    def __init__(self, indices, seed=None):
         self.indices = indices
+        self._init_seed(seed)
 
     def __iter__(self):
-        return (self.indices[i] for i in np.random.permutation(len(self.indices)))
+        return (self.indices[i] for i in self._iter_rng().permutation(len(self.indices)))
 
     def __len__(self):
         return len(self.indices)
 
 
+class ShardedSampler(Sampler):
+    """Samples the elements of one of ``num_shards`` disjoint shards of the dataset
+
+    Meant for data-parallel runs over multiple nodes: each node creates the
+    sampler with its own ``shard_id`` and the same remaining arguments. The shards
+    are contiguous ranges of the (shuffled) index space.
+
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        num_shards (int): number of shards
+        shard_id (int): shard sampled by this sampler, in ``[0, num_shards)``
+        shuffle (bool): if ``True``, shuffle the indices before sharding. The
+            permutation is determined by ``seed`` and ``epoch`` and is hence the same
+            on all the nodes.
+        seed (int): random seed used with ``shuffle``
+        epoch (int): epoch of the permutation (see `set_epoch`)
+        pad (bool): if ``True``, all the shards have the same length. The shards
+            at the end are padded with the indices at the beginning. Otherwise
+            the shard lengths differ by at most one.
+    """
+
+    def __init__(self, data_source, num_shards, shard_id, shuffle=False, seed=0, epoch=0, pad=True):
+        if not 0 <= shard_id < num_shards:
+            raise ValueError("shard_id needs to be in [0, num_shards)")
+        self.data_source = data_source
+        self.num_shards = num_shards
+        self.shard_id = shard_id
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = epoch
+        self.pad = pad
+
+    def set_epoch(self, epoch):
+        """Set the epoch of the permutation. Call it on all the nodes before each epoch.
+        """
+        self.epoch = epoch
+
+    def _shard_range(self):
+        n = len(self.data_source)
+        if self.pad:
+            size = (n + self.num_shards - 1) // self.num_shards
+            return self.shard_id * size, (self.shard_id + 1) * size
+        # the first `n % num_shards` shards get one element more
+        size, rest = divmod(n, self.num_shards)
+        start = self.shard_id * size + min(self.shard_id, rest)
+        return start, start + size + (self.shard_id < rest)
+
+    def __iter__(self):
+        n = len(self.data_source)
+        if self.shuffle:
+            indices = np.random.RandomState(self.seed + self.epoch).permutation(n)
+        else:
+            indices = np.arange(n)
+        start, end = self._shard_range()
+        if end > n and n > 0:
+            indices = np.resize(indices, end)
+        return iter(indices[start:end])
+
+    def __len__(self):
+        if len(self.data_source) == 0:
+            return 0
+        start, end = self._shard_range()
+        return end - start
+
+    def state_dict(self):
+        return {'epoch': self.epoch}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+
+
+def _index_dtype(n):
+    """Smallest of int32 and int64 able to hold the indices of `n` elements
+    """
+    return np.int32 if n <= np.iinfo(np.int32).max else np.int64
+
+
+class _GeneratorStateMixin(object):
+    """Records the state of a `np.random.Generator` at the beginning of each iteration
+
+    Restoring the state reproduces the iteration and the following ones.
+    """
+
+    def _init_generator(self, generator):
+        self.generator = generator if generator is not None else np.random.default_rng()
+        self.iter_state = None
+        self.resume_state = None
+
+    def _iter_generator(self):
+        """Random number generator of a new iteration
+        """
+        bit_generator = self.generator.bit_generator
+        if self.resume_state is not None:
+            bit_generator.state, self.resume_state = self.resume_state, None
+        self.iter_state = bit_generator.state
+        return self.generator
+
+    def state_dict(self):
+        return {'generator_state': self.iter_state}
+
+    def load_state_dict(self, state_dict):
+        self.resume_state = state_dict['generator_state']
+
+
+class ArraySequentialSampler(Sampler):
+    """Array-native `SequentialSampler`. `indices` returns all the indices
+    of an iteration as a single numpy array.
+
+    Arguments:
+        data_source (Dataset): dataset to sample from
+    """
+
+    def __init__(self, data_source):
+        self.data_source = data_source
+
+    def indices(self):
+        """Indices of a new iteration (int32 if the dataset size allows it)
+        """
+        n = len(self.data_source)
+        return np.arange(n, dtype=_index_dtype(n))
+
+    def __iter__(self):
+        return iter(self.indices())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+class ArrayRandomSampler(_GeneratorStateMixin, Sampler):
+    """Array-native `RandomSampler`. `indices` returns the permutation of an
+    iteration as a single numpy array.
+
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        generator (np.random.Generator, optional): random number generator. If None,
+            a new generator seeded from the OS entropy is used.
+    """
+
+    def __init__(self, data_source, generator=None):
+        self.data_source = data_source
+        self._init_generator(generator)
+
+    def indices(self):
+        """Permutation of a new iteration (int32 if the dataset size allows it)
+        """
+        n = len(self.data_source)
+        idx = np.arange(n, dtype=_index_dtype(n))
+        self._iter_generator().shuffle(idx)
+        return idx
+
+    def __iter__(self):
+        return iter(self.indices())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+class ArraySubsetRandomSampler(_GeneratorStateMixin, Sampler):
+    """Array-native `SubsetRandomSampler`. `indices` returns the permuted subset
+    of an iteration as a single numpy array.
+
+    Arguments:
+        indices (array-like): indices of the subset
+        generator (np.random.Generator, optional): random number generator. If None,
+            a new generator seeded from the OS entropy is used.
+    """
+
+    def __init__(self, indices, generator=None):
+        self.subset = np.asarray(indices)
+        self._init_generator(generator)
+
+    def indices(self):
+        """Permuted subset of a new iteration
+        """
+        n = len(self.subset)
+        perm = np.arange(n, dtype=_index_dtype(n))
+        self._iter_generator().shuffle(perm)
+        return self.subset[perm]
+
+    def __iter__(self):
+        return iter(self.indices())
+
+    def __len__(self):
+        return len(self.subset)
+
+
+class BlockShuffleSampler(_GeneratorStateMixin, Sampler):
+    """Samples blocks of contiguous indices in random order
+
+    Preserves read locality for datasets stored in chunks on disk (e.g. HDF5,
+    zarr or sorted genomic regions): the index space is split into blocks of
+    ``block_size`` contiguous indices which are shuffled, while the order within
+    each block is kept. Optionally, the resulting order is sorted by ``sort_key``
+    (e.g. chromosome and position) within consecutive windows of ``shuffle_window``
+    indices, so that the batches drawn from a window read mostly sequentially.
+
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        block_size (int): number of contiguous indices per block
+        shuffle_window (int, optional): size of the windows sorted by ``sort_key``
+            (default: ``block_size``)
+        sort_key (array or list of arrays, optional): per-sample sort key of length
+            ``len(data_source)``. A list of arrays is sorted by the first array,
+            then by the second etc.
+        generator (np.random.Generator, optional): random number generator. If None,
+            a new generator seeded from the OS entropy is used.
+    """
+
+    def __init__(self, data_source, block_size, shuffle_window=None, sort_key=None, generator=None):
+        if block_size < 1:
+            raise ValueError("block_size needs to be at least 1")
+        if shuffle_window is not None and shuffle_window < 1:
+            raise ValueError("shuffle_window needs to be at least 1")
+        self.data_source = data_source
+        self.block_size = block_size
+        self.shuffle_window = shuffle_window or block_size
+        if sort_key is not None:
+            if isinstance(sort_key, np.ndarray) and sort_key.ndim == 1:
+                sort_key = [sort_key]
+            sort_key = [np.asarray(k) for k in sort_key]
+            if any(len(k) != len(data_source) for k in sort_key):
+                raise ValueError("sort_key needs to have the same length as data_source")
+        self.sort_key = sort_key
+        self._init_generator(generator)
+
+    def indices(self):
+        """Indices of a new iteration (int32 if the dataset size allows it)
+        """
+        n = len(self.data_source)
+        dtype = _index_dtype(n + self.block_size)
+        blocks = np.arange((n + self.block_size - 1) // self.block_size, dtype=dtype)
+        self._iter_generator().shuffle(blocks)
+        idx = (blocks[:, np.newaxis] * self.block_size +
+               np.arange(self.block_size, dtype=dtype)).ravel()
+        if n % self.block_size:
+            # incomplete last block
+            idx = idx[idx < n]
+        if self.sort_key is not None:
+            window = np.arange(n, dtype=dtype) // self.shuffle_window
+            # np.lexsort sorts by the last key first
+            order = np.lexsort([k[idx] for k in self.sort_key[::-1]] + [window])
+            idx = idx[order]
+        return idx.astype(_index_dtype(n), copy=False)
+
+    def __iter__(self):
+        return iter(self.indices())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+class _AliasTable(object):
+    """Walker's alias table for O(1) draws from a discrete distribution
+
+    Built in vectorized rounds: all the entries with less than the average weight
+    are paired at once with the entries whose excess weight covers them.
+    """
+
+    def __init__(self, weights):
+        w = np.asarray(weights, dtype=np.float64)
+        if w.ndim != 1 or np.any(w < 0) or not w.sum() > 0:
+            raise ValueError("weights need to be a 1-D array of non-negative numbers with a positive sum")
+        n = len(w)
+        q = w * (n / w.sum())
+        self.prob = np.ones(n)
+        self.alias = np.arange(n, dtype=_index_dtype(n))
+        small = np.flatnonzero(q < 1)
+        large = np.flatnonzero(q >= 1)
+        while len(small) and len(large):
+            deficit = 1 - q[small]
+            # pair each small entry with the large entry in which its deficit starts
+            start = np.cumsum(deficit) - deficit
+            j = np.searchsorted(np.cumsum(q[large] - 1), start, side='right')
+            j = np.minimum(j, len(large) - 1)  # rounding errors
+            self.prob[small] = q[small]
+            self.alias[small] = large[j]
+            q[large] -= np.bincount(j, weights=deficit, minlength=len(large))
+            # large entries falling below the average are paired in the next round
+            is_small = q[large] < 1
+            small, large = large[is_small], large[~is_small]
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self, rng, size):
+        """Draw `size` indices using the `np.random.Generator` `rng`
+        """
+        i = rng.integers(0, len(self), size=size, dtype=self.alias.dtype)
+        return np.where(rng.random(size) < self.prob[i], i, self.alias[i])
+
+
+class WeightedRandomSampler(_GeneratorStateMixin, Sampler):
+    """Samples elements with probabilities proportional to ``weights``
+
+    Draws with replacement use a precomputed alias table (O(1) per draw). Draws without
+    replacement use random keys ``log(u) / weight`` (Efraimidis-Spirakis), taking the
+    ``num_samples`` largest keys in O(n), since alias tables can't exclude drawn elements.
+
+    Arguments:
+        weights (array-like): non-negative sampling weight of each element
+        num_samples (int, optional): number of samples to draw per iteration
+            (default: ``len(weights)``)
+        replacement (bool): draw with replacement
+        generator (np.random.Generator, optional): random number generator. If None,
+            a new generator seeded from the OS entropy is used.
+    """
+
+    def __init__(self, weights, num_samples=None, replacement=True, generator=None):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.num_samples = len(self.weights) if num_samples is None else num_samples
+        self.replacement = replacement
+        if replacement:
+            self.alias_table = _AliasTable(self.weights)
+        else:
+            if np.any(self.weights < 0):
+                raise ValueError("weights need to be non-negative")
+            if self.num_samples > np.count_nonzero(self.weights):
+                raise ValueError("num_samples can't exceed the number of non-zero weights "
+                                 "when drawing without replacement")
+        self._init_generator(generator)
+
+    def indices(self):
+        """Indices drawn in a new iteration
+        """
+        rng = self._iter_generator()
+        if self.replacement:
+            return self.alias_table.draw(rng, self.num_samples)
+        if self.num_samples == 0:
+            return np.zeros(0, dtype=_index_dtype(len(self.weights)))
+        with np.errstate(divide='ignore'):
+            keys = np.log(rng.random(len(self.weights))) / self.weights
+        top = np.argpartition(-keys, self.num_samples - 1)[:self.num_samples]
+        # order of the sequential draws
+        top = top[np.argsort(-keys[top], kind='stable')]
+        return top.astype(_index_dtype(len(self.weights)), copy=False)
+
+    def __iter__(self):
+        return iter(self.indices())
+
+    def __len__(self):
+        return self.num_samples
+
+
 class BatchSampler(object):
     """Wraps another sampler to yield a mini-batch of indices.
     Args:
@@ -86,8 +475,12 @@ class BatchSampler(object):
         self.drop_last = drop_last
 
     def __iter__(self):
+        # start the iteration of the sampler right away
+        return self._iter_batches(iter(self.sampler))
+
+    def _iter_batches(self, sampler_iter):
         batch = []
-        for idx in self.sampler:
+        for idx in sampler_iter:
             batch.append(idx)
             if len(batch) == self.batch_size:
                 yield batch
@@ -100,3 +493,258 @@ class BatchSampler(object):
             return len(self.sampler) // self.batch_size
         else:
             return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def state_dict(self):
+        if hasattr(self.sampler, 'state_dict'):
+            return {'sampler': self.sampler.state_dict()}
+        return {}
+
+    def load_state_dict(self, state_dict):
+        if 'sampler' in state_dict:
+            self.sampler.load_state_dict(state_dict['sampler'])
+
+
+class InterleavedBatchSampler(_IterSeedMixin):
+    """Interleaves the batches of several batch samplers
+
+    Yields the batches as lists of ``(sampler_idx, idx)`` tuples.
+
+    Args:
+        batch_samplers (list): batch samplers to interleave
+        policy (str): ``'round_robin'`` takes one batch from each of the not yet
+            exhausted samplers in turn, ``'weighted'`` draws the sampler of each batch
+            at random with probabilities proportional to ``weights``.
+        weights (list, optional): sampling weights of the batch samplers
+            for ``policy='weighted'``
+        seed (int, optional): random seed for ``policy='weighted'``
+    """
+
+    def __init__(self, batch_samplers, policy='round_robin', weights=None, seed=None):
+        if policy not in ('round_robin', 'weighted'):
+            raise ValueError("policy needs to be 'round_robin' or 'weighted'")
+        if policy == 'weighted':
+            if weights is None or len(weights) != len(batch_samplers):
+                raise ValueError("weights need to be specified for each batch sampler")
+            if np.any(np.asarray(weights) < 0) or not np.any(np.asarray(weights) > 0):
+                raise ValueError("weights need to be non-negative with a positive sum")
+        self.batch_samplers = batch_samplers
+        self.policy = policy
+        self.weights = weights
+        self._init_seed(seed)
+
+    def __iter__(self):
+        # start the iteration of the batch samplers right away
+        return self._iter_batches([iter(s) for s in self.batch_samplers], self._iter_rng())
+
+    def _iter_batches(self, iters, rng):
+        active = list(range(len(iters)))
+        weights = np.asarray(self.weights, dtype=float) if self.policy == 'weighted' else None
+        i = 0
+        while active:
+            if self.policy == 'round_robin':
+                i = i % len(active)
+                j = active[i]
+            else:
+                w = weights[active]
+                if not w.sum() > 0:
+                    # only zero-weight samplers left
+                    w = np.ones(len(active))
+                i = rng.choice(len(active), p=w / w.sum())
+                j = active[i]
+            batch = next(iters[j], None)
+            if batch is None:
+                del active[i]
+                continue
+            yield [(j, idx) for idx in batch]
+            i += 1
+
+    def __len__(self):
+        return sum(len(s) for s in self.batch_samplers)
+
+    def state_dict(self):
+        state = super(InterleavedBatchSampler, self).state_dict()
+        state['batch_samplers'] = [s.state_dict() if hasattr(s, 'state_dict') else {}
+                                   for s in self.batch_samplers]
+        return state
+
+    def load_state_dict(self, state_dict):
+        super(InterleavedBatchSampler, self).load_state_dict(state_dict)
+        for s, state in zip(self.batch_samplers, state_dict['batch_samplers']):
+            if hasattr(s, 'load_state_dict'):
+                s.load_state_dict(state)
+
+
+class ArrayBatchSampler(BatchSampler):
+    """Array-native `BatchSampler` yielding the batches as numpy arrays
+
+    The batches are slices of the array returned by ``sampler.indices()`` (see
+    e.g. `ArrayRandomSampler`) instead of lists built one index at a time.
+    Samplers without ``indices`` are materialized into an array first.
+
+    Args:
+        sampler (Sampler): Base sampler.
+        batch_size (int): Size of mini-batch.
+        drop_last (bool): If ``True``, the sampler will drop the last batch if
+            its size would be less than ``batch_size``
+    Example:
+        >>> [list(b) for b in ArrayBatchSampler(ArraySequentialSampler(range(5)), 2, False)]
+        [[0, 1], [2, 3], [4]]
+    """
+
+    def __iter__(self):
+        if hasattr(self.sampler, 'indices'):
+            indices = self.sampler.indices()
+        else:
+            indices = np.asarray(list(self.sampler))
+        return self._iter_batches(indices)
+
+    def _iter_batches(self, indices):
+        n = len(indices)
+        if self.drop_last:
+            n -= n % self.batch_size
+        for start in range(0, n, self.batch_size):
+            yield indices[start:start + self.batch_size]
+
+
+class BucketBatchSampler(_GeneratorStateMixin):
+    """Batches samples of similar length under a budget of padded elements
+
+    The samples are sorted by length and split greedily into batches whose padded
+    size, ``len(batch) * max(lengths[batch])``, stays within ``max_tokens``. The batch
+    boundaries only depend on the lengths, hence ``len()`` is exact. With ``shuffle``,
+    the order of the batches as well as the grouping of the samples with equal length
+    is randomized in each iteration. Yields the batches as numpy arrays.
+
+    Args:
+        lengths (array-like): length of each sample in the dataset
+        max_tokens (int): maximal number of padded elements per batch. Samples longer
+            than ``max_tokens`` form a batch on their own.
+        max_batch_size (int, optional): maximal number of samples per batch
+        shuffle (bool): shuffle the batches
+        generator (np.random.Generator, optional): random number generator. If None,
+            a new generator seeded from the OS entropy is used.
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None, shuffle=True, generator=None):
+        lengths = np.asarray(lengths)
+        if lengths.ndim != 1:
+            raise ValueError("lengths needs to be a 1-D array")
+        if max_tokens < 1:
+            raise ValueError("max_tokens needs to be at least 1")
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self._init_generator(generator)
+        self.bounds = self._batch_bounds(np.sort(lengths))
+
+    def _batch_bounds(self, sorted_lengths):
+        """Start offsets of the batches in the sorted order, followed by the end
+        """
+        n = len(sorted_lengths)
+        bounds = [0]
+        while bounds[-1] < n:
+            start = bounds[-1]
+            # padded size sorted_lengths[end - 1] * (end - start) increases with end:
+            # binary search for the last end within the budget
+            lo, hi = start + 1, n
+            if self.max_batch_size is not None:
+                hi = min(hi, start + self.max_batch_size)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if sorted_lengths[mid - 1] * (mid - start) <= self.max_tokens:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            bounds.append(lo)
+        return np.array(bounds, dtype=np.int64)
+
+    def __iter__(self):
+        n = len(self.lengths)
+        dtype = _index_dtype(n)
+        if self.shuffle:
+            rng = self._iter_generator()
+            # randomize the order of samples with the same length
+            perm = np.arange(n, dtype=dtype)
+            rng.shuffle(perm)
+            order = perm[np.argsort(self.lengths[perm], kind='stable')]
+            batch_order = rng.permutation(len(self))
+        else:
+            order = np.argsort(self.lengths, kind='stable').astype(dtype, copy=False)
+            batch_order = range(len(self))
+        return (order[self.bounds[i]:self.bounds[i + 1]] for i in batch_order)
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+
+class StratifiedBatchSampler(_GeneratorStateMixin):
+    """Yields batches with balanced per-class counts
+
+    Each batch contains ``floor(p_c * batch_size)`` samples of class ``c`` where ``p_c``
+    are the normalized ``class_weights``; the remaining slots of the batch are given
+    to classes drawn from ``p`` with an alias table. The samples of each class are
+    taken from a per-class permutation, reshuffled whenever it is exhausted, hence
+    rare classes get oversampled without materializing repeated index lists.
+    Yields the batches as numpy arrays.
+
+    Args:
+        labels (array-like): class label of each sample in the dataset
+        batch_size (int): size of mini-batch
+        num_batches (int, optional): number of batches per iteration
+            (default: ``len(labels) // batch_size``)
+        class_weights (dict or array-like, optional): sampling weight of each class,
+            either a dictionary keyed by label or an array following the order of
+            ``np.unique(labels)``. Uniform by default.
+        generator (np.random.Generator, optional): random number generator. If None,
+            a new generator seeded from the OS entropy is used.
+    """
+
+    def __init__(self, labels, batch_size, num_batches=None, class_weights=None, generator=None):
+        labels = np.asarray(labels)
+        self.classes, inverse = np.unique(labels, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable').astype(_index_dtype(len(labels)), copy=False)
+        self.class_indices = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        if class_weights is None:
+            p = np.ones(len(self.classes))
+        elif isinstance(class_weights, dict):
+            p = np.array([class_weights.get(c, 0) for c in self.classes], dtype=np.float64)
+        else:
+            p = np.asarray(class_weights, dtype=np.float64)
+            if len(p) != len(self.classes):
+                raise ValueError("class_weights need to be specified for each class")
+        self.class_table = _AliasTable(p)
+        self.quota = np.floor(p / p.sum() * batch_size).astype(np.int64)
+        self.batch_size = batch_size
+        self.num_batches = len(labels) // batch_size if num_batches is None else num_batches
+        self._init_generator(generator)
+
+    def __iter__(self):
+        return self._iter_batches(self._iter_generator())
+
+    def _iter_batches(self, rng):
+        perms = [rng.permutation(idx) for idx in self.class_indices]
+        pos = [0] * len(perms)
+        n_extra = self.batch_size - self.quota.sum()
+        for _ in range(self.num_batches):
+            counts = self.quota.copy()
+            if n_extra:
+                counts += np.bincount(self.class_table.draw(rng, n_extra), minlength=len(counts))
+            parts = []
+            for c in np.flatnonzero(counts):
+                n = counts[c]
+                while n:
+                    if pos[c] == len(perms[c]):
+                        perms[c] = rng.permutation(self.class_indices[c])
+                        pos[c] = 0
+                    take = min(n, len(perms[c]) - pos[c])
+                    parts.append(perms[c][pos[c]:pos[c] + take])
+                    pos[c] += take
+                    n -= take
+            batch = np.concatenate(parts)
+            rng.shuffle(batch)
+            yield batch
+
+    def __len__(self):
+        return self.num_batches
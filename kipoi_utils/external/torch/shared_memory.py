@@ -0,0 +1,318 @@
+"""Shared memory between DataLoader workers and the parent
+
+Transport of collated batches (`SlabPool`): workers copy the numpy leaves of a
+collated batch into one of a fixed number of reusable shared-memory slabs and only
+send a small descriptor through the data queue. The parent rebuilds the nested
+structure as views into the slab and hands the slab back to the pool once all the
+views have been garbage-collected.
+
+Sharing of the built dataset (`SharedDataset`): the dataset is built once in the
+parent and the workers attach to its large numpy arrays read-only.
+"""
+import io
+import mmap
+import os
+import pickle
+import tempfile
+import threading
+import weakref
+import multiprocessing
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory as _shared_memory
+except ImportError:
+    # python < 3.8
+    _shared_memory = None
+
+# byte alignment of the individual arrays within a slab
+_ALIGN = 64
+
+
+class _MmapSlab(object):
+    """File-backed replacement of `multiprocessing.shared_memory.SharedMemory`
+    used on python < 3.8
+    """
+
+    def __init__(self, size, path=None):
+        if path is None:
+            tmpdir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            fd, path = tempfile.mkstemp(prefix="kipoi_slab_", dir=tmpdir)
+            os.ftruncate(fd, size)
+        else:
+            fd = os.open(path, os.O_RDWR)
+        self.name = path
+        self.size = size
+        self._mmap = mmap.mmap(fd, size)
+        os.close(fd)
+        self.buf = memoryview(self._mmap)
+
+    def __reduce__(self):
+        return (self.__class__, (self.size, self.name))
+
+    def close(self):
+        # arrays built on the slab keep the mapping alive through `buf`
+        self.buf = None
+        self._mmap = None
+
+    def unlink(self):
+        try:
+            os.remove(self.name)
+        except OSError:
+            pass
+
+
+if _shared_memory is not None:
+    class _SharedMemory(_shared_memory.SharedMemory):
+        """`SharedMemory` which can be closed while numpy arrays still view it
+
+        `SharedMemory.close` (also called by `__del__`) raises `BufferError` as long as
+        arrays built on `buf` exist, e.g. when the pool is garbage-collected before the
+        batches read from it. The mapping is then released together with the last array.
+        """
+
+        def close(self):
+            try:
+                super(_SharedMemory, self).close()
+            except BufferError:
+                # the arrays keep `buf` and the mmap alive
+                self._buf = None
+                self._mmap = None
+                if getattr(self, '_fd', -1) >= 0:
+                    os.close(self._fd)
+                    self._fd = -1
+
+
+def _create_slab(size):
+    if _shared_memory is not None:
+        return _SharedMemory(create=True, size=size)
+    else:
+        return _MmapSlab(size)
+
+
+class SharedArray(object):
+    """Location of a single array within a slab"""
+    __slots__ = ('offset', 'shape', 'dtype')
+
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+class SharedBatch(object):
+    """Batch whose array leaves live in the slab `slab_idx`
+
+    `tree` mirrors the nested structure of the batch with array leaves replaced
+    by `SharedArray` descriptors.
+    """
+    __slots__ = ('slab_idx', 'tree', 'nbytes')
+
+    def __init__(self, slab_idx, tree, nbytes):
+        self.slab_idx = slab_idx
+        self.tree = tree
+        self.nbytes = nbytes
+
+
+def _is_shareable(arr):
+    return (isinstance(arr, np.ndarray) and not arr.dtype.hasobject and
+            arr.dtype.itemsize > 0 and arr.size > 0)
+
+
+def _layout(batch, arrays, offset):
+    """Replace the shareable arrays in `batch` by `SharedArray` descriptors
+
+    The replaced arrays are appended to `arrays` as (descriptor, array) tuples.
+    Returns the new tree and the end offset.
+    """
+    if _is_shareable(batch):
+        offset = (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+        desc = SharedArray(offset, batch.shape, batch.dtype.str)
+        arrays.append((desc, batch))
+        return desc, offset + batch.nbytes
+    elif isinstance(batch, dict) or type(batch) in (list, tuple):
+        if isinstance(batch, dict):
+            out = type(batch)()
+            for k, v in batch.items():
+                out[k], offset = _layout(v, arrays, offset)
+        else:
+            out = []
+            for v in batch:
+                v, offset = _layout(v, arrays, offset)
+                out.append(v)
+            out = type(batch)(out)
+        return out, offset
+    else:
+        return batch, offset
+
+
+def _rebuild(tree, base):
+    if isinstance(tree, SharedArray):
+        dtype = np.dtype(tree.dtype)
+        nbytes = int(np.prod(tree.shape)) * dtype.itemsize
+        return base[tree.offset:tree.offset + nbytes].view(dtype).reshape(tree.shape)
+    elif isinstance(tree, dict):
+        out = type(tree)()
+        for k, v in tree.items():
+            out[k] = _rebuild(v, base)
+        return out
+    elif type(tree) in (list, tuple):
+        return type(tree)([_rebuild(v, base) for v in tree])
+    else:
+        return tree
+
+
+class SlabPool(object):
+    """Pool of reusable shared-memory slabs
+
+    Created in the parent process before the workers are started. Workers call
+    `write` to move a collated batch into a free slab; the parent calls `read` to
+    obtain zero-copy views. A slab is returned to the pool when all the arrays
+    returned by `read` have been released by the consumer.
+
+    Arguments:
+        num_slabs (int): number of slabs in the pool
+        slab_size (int): size of each slab in bytes. Batches not fitting into
+            a single slab are sent through the queue as usual.
+    """
+
+    def __init__(self, num_slabs, slab_size):
+        self.slab_size = slab_size
+        self.slabs = [_create_slab(slab_size) for _ in range(num_slabs)]
+        # free slab indices, written by the parent and read by the workers
+        self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+        self._rlock = multiprocessing.Lock()
+        self._wlock = threading.Lock()
+        self._closed = False
+        for i in range(num_slabs):
+            self._writer.send(i)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_writer']
+        del state['_wlock']
+        return state
+
+    def _acquire(self):
+        """Get a free slab index or None if all slabs are in use (non-blocking)
+        """
+        with self._rlock:
+            if self._reader.poll():
+                return self._reader.recv()
+        return None
+
+    def _release(self, slab_idx):
+        with self._wlock:
+            if not self._closed:
+                self._writer.send(slab_idx)
+
+    def write(self, batch):
+        """Move the arrays of `batch` into a free slab (worker side)
+
+        Returns a `SharedBatch` or the unmodified batch if it has no
+        shareable arrays, doesn't fit into a slab or no slab is free.
+        """
+        arrays = []
+        tree, nbytes = _layout(batch, arrays, 0)
+        if not arrays or nbytes > self.slab_size:
+            return batch
+        slab_idx = self._acquire()
+        if slab_idx is None:
+            return batch
+        buf = self.slabs[slab_idx].buf
+        for desc, arr in arrays:
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=buf, offset=desc.offset)[...] = arr
+        return SharedBatch(slab_idx, tree, nbytes)
+
+    def read(self, shared_batch):
+        """Rebuild the batch as views into the slab (parent side)
+        """
+        base = np.frombuffer(self.slabs[shared_batch.slab_idx].buf, dtype=np.uint8)
+        # all the views keep `base` alive; give the slab back once they are gone
+        weakref.finalize(base, self._release, shared_batch.slab_idx)
+        return _rebuild(shared_batch.tree, base)
+
+    def discard(self, shared_batch):
+        """Give back the slab of a batch which won't be read
+        """
+        self._release(shared_batch.slab_idx)
+
+    def close(self):
+        """Unlink and close the slabs. Memory is freed once the last view is gone
+        """
+        with self._wlock:
+            if self._closed:
+                return
+            self._closed = True
+        for slab in self.slabs:
+            slab.unlink()
+            slab.close()
+
+
+class _SharingPickler(pickle.Pickler):
+    """Pickler moving large numpy arrays into shared-memory slabs"""
+
+    def __init__(self, file, slabs, min_bytes):
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.slabs = slabs
+        self.min_bytes = min_bytes
+        # id(array) -> (array, persistent id). Keeps the arrays alive while pickling
+        self.shared = {}
+
+    def persistent_id(self, obj):
+        if (type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or
+                obj.nbytes < max(self.min_bytes, 1)):
+            return None
+        if id(obj) not in self.shared:
+            slab = _create_slab(obj.nbytes)
+            np.ndarray(obj.shape, dtype=obj.dtype, buffer=slab.buf)[...] = obj
+            self.slabs.append(slab)
+            self.shared[id(obj)] = (obj, (len(self.slabs) - 1, obj.shape, obj.dtype.str))
+        return self.shared[id(obj)][1]
+
+
+class _AttachingUnpickler(pickle.Unpickler):
+    """Unpickler restoring the arrays pickled by `_SharingPickler` as
+    read-only views into the shared-memory slabs"""
+
+    def __init__(self, file, slabs):
+        pickle.Unpickler.__init__(self, file)
+        self.slabs = slabs
+
+    def persistent_load(self, pid):
+        slab_idx, shape, dtype = pid
+        arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.slabs[slab_idx].buf)
+        arr.flags.writeable = False
+        return arr
+
+
+class SharedDataset(object):
+    """Built dataset whose large numpy arrays live in shared memory
+
+    The dataset is pickled once in the parent process with all the numpy
+    arrays of at least `min_bytes` (also the ones held by pandas objects)
+    moved into shared-memory slabs. Workers call `load` to unpickle their
+    own copy of the dataset attached read-only to the shared arrays instead
+    of building the dataset again.
+
+    Arguments:
+        dataset: built dataset. Needs to be picklable.
+        min_bytes (int): smallest array moved to shared memory
+    """
+
+    def __init__(self, dataset, min_bytes=2**16):
+        self.slabs = []
+        buf = io.BytesIO()
+        _SharingPickler(buf, self.slabs, min_bytes).dump(dataset)
+        self.payload = buf.getvalue()
+
+    def load(self):
+        """Unpickle the dataset attached to the shared arrays
+        """
+        return _AttachingUnpickler(io.BytesIO(self.payload), self.slabs).load()
+
+    def close(self):
+        """Unlink the slabs. Memory is freed once all the workers exited
+        """
+        for slab in self.slabs:
+            slab.unlink()
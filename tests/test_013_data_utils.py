@@ -57,3 +57,268 @@ def test_preloaded_dataset(data):
     assert len(d) == 3
     assert d[1] == {"a": [1], "b": {"d": 1}, "c": np.array([1])}
     assert list(d.batch_iter(2))[1] == {'a': [np.array([2])], 'b': {'d': np.array([2])}, 'c': np.array([[2]])}
+
+
+def test_dataloader_iterable_async():
+    import asyncio
+    from kipoi_utils.data_utils import DataloaderIterable
+    from kipoi_utils.external.torch.data import DataLoader
+
+    class Dl(object):
+        def batch_iter(self, batch_size, num_workers=0):
+            if num_workers:
+                return iter(DataLoader(np.arange(10), batch_size=batch_size,
+                                       num_workers=num_workers))
+            return (np.arange(i, min(i + batch_size, 10)) for i in range(0, 10, batch_size))
+
+    async def collect(it):
+        return [b async for b in it]
+
+    loop = asyncio.new_event_loop()
+    try:
+        for num_workers in [0, 2]:
+            it = DataloaderIterable(Dl(), dict(batch_size=3, num_workers=num_workers))
+            batches = loop.run_until_complete(collect(it))
+            assert list(np.concatenate(batches)) == list(range(10))
+            assert len(batches) == 4
+    finally:
+        loop.close()
+
+
+def test_batch_transforms():
+    from kipoi_utils.data_utils import (cast_transform, normalize_transform,
+                                        reverse_complement_transform, map_batch)
+    batch = {"inputs": {"seq": np.eye(4)[[[0, 1, 2], [0, 0, 3]]].astype(np.float64)},
+             "targets": [np.arange(2, dtype=np.float64)]}
+
+    out = cast_transform()(batch)
+    assert out["inputs"]["seq"].dtype == np.float32
+    assert out["targets"][0].dtype == np.float32
+    assert batch["targets"][0].dtype == np.float64
+
+    out = cast_transform(path="targets/0")(batch)
+    assert out["inputs"]["seq"].dtype == np.float64
+    assert out["targets"][0].dtype == np.float32
+
+    out = normalize_transform(1, 2, path="targets/0")(batch)
+    assert list(out["targets"][0]) == [-0.5, 0]
+
+    out = reverse_complement_transform(path="inputs/seq", p=1)(batch)
+    # ACG -> CGT, AAT -> ATT
+    np.testing.assert_equal(out["inputs"]["seq"], np.eye(4)[[[1, 2, 3], [0, 3, 3]]])
+    out = reverse_complement_transform(path="inputs/seq", p=0)(batch)
+    np.testing.assert_equal(out["inputs"]["seq"], batch["inputs"]["seq"])
+
+    with pytest.raises(ValueError):
+        map_batch(np.sum, path="targets/0/a")(batch)
+
+
+def test_compiled_collate():
+    import pickle
+    from kipoi_utils.data_utils import CompiledCollate, numpy_collate
+    # numpy scalars of different lengths / units
+    chroms = np.array(["chr1", "chr10", "chrX"])
+    dates = [np.datetime64('2020-01-01'), np.datetime64('2020-01-01T10:30')]
+
+    def sample(i):
+        return {"inputs": {"seq": np.full((4, 2), i), "score": np.float32(i)},
+                "targets": [i, float(i)],
+                "metadata": {"ranges": {"chr": chroms[i % 3], "start": i}, "id": str(i),
+                             "date": dates[i % 2]}}
+
+    def check(a, b):
+        if isinstance(a, dict):
+            assert list(a) == list(b)
+            for k in a:
+                check(a[k], b[k])
+        elif isinstance(a, list):
+            assert len(a) == len(b)
+            for x, y in zip(a, b):
+                check(x, y)
+        else:
+            assert a.dtype == b.dtype
+            np.testing.assert_array_equal(a, b)
+
+    collate = CompiledCollate()
+    for start in [0, 3]:
+        batch = [sample(i) for i in range(start, start + 3)]
+        check(collate(batch), numpy_collate(batch))
+    assert collate.leaf_paths == [("inputs", "seq"), ("inputs", "score"), ("targets", 0),
+                                  ("targets", 1), ("metadata", "ranges", "chr"),
+                                  ("metadata", "ranges", "start"), ("metadata", "id"),
+                                  ("metadata", "date")]
+
+    # a different structure falls back to the generic collate
+    batch = [{"inputs": np.arange(i, i + 2)} for i in range(3)]
+    check(collate(batch), numpy_collate(batch))
+    batch = [dict(sample(i), extra=i) for i in range(3)]
+    check(collate(batch), numpy_collate(batch))
+
+    # picklable for the DataLoader workers
+    collate = pickle.loads(pickle.dumps(collate))
+    batch = [sample(i) for i in range(3)]
+    check(collate(batch), numpy_collate(batch))
+
+
+def test_buffer_ring():
+    import gc
+    from kipoi_utils.data_utils import BufferRing, CompiledCollate, numpy_collate
+
+    ring = BufferRing(min_bytes=0)
+    a = ring([np.ones(3), np.zeros(3)])
+    np.testing.assert_array_equal(a, np.stack([np.ones(3), np.zeros(3)]))
+    view = a[1:]
+    del a
+    gc.collect()
+    # the buffer is still in use by the view
+    b = ring([np.ones(3), np.ones(3)])
+    assert ring.allocations == 2
+    np.testing.assert_array_equal(view, np.zeros((1, 3)))
+    del view, b
+    gc.collect()
+    # recycled
+    ring([np.ones(3), np.ones(3)])
+    assert ring.allocations == 2
+
+    # different shapes or small outputs are stacked as usual
+    c = BufferRing(np.concatenate, min_bytes=0)([np.ones((1, 2)), np.zeros((2, 2))])
+    assert c.shape == (3, 2)
+    with pytest.raises(ValueError):
+        BufferRing(min_bytes=0)([np.ones(3), np.ones(2)])
+
+    collate = CompiledCollate(BufferRing(min_bytes=0))
+    batch = [{"x": np.full((2, 2), i), "y": i} for i in range(4)]
+    out = collate(batch)
+    np.testing.assert_array_equal(out["x"], numpy_collate(batch)["x"])
+
+
+def test_ragged_collate():
+    from kipoi_utils.data_utils import RaggedCollate, ragged_to_list, decode_strings
+
+    batch = [{"seq": np.ones((n, 4)), "fixed": np.arange(2), "id": "sample_{}".format(n), "n": n}
+             for n in [3, 1, 2]]
+    out = RaggedCollate()(batch)
+    assert out["fixed"].shape == (3, 2)
+    assert out["seq"]["values"].shape == (3, 3, 4)
+    assert list(out["seq"]["lengths"]) == [3, 1, 2]
+    assert out["seq"]["values"][1, 1:].sum() == 0
+    assert out["id"]["values"].dtype == np.uint8
+    assert decode_strings(out["id"]) == ["sample_3", "sample_1", "sample_2"]
+    assert list(out["n"]) == [3, 1, 2]
+
+    out = RaggedCollate({"seq": "ragged", "id": "stack"}, pad_value=-1)(batch)
+    assert list(out["seq"]["offsets"]) == [0, 3, 4, 6]
+    assert [len(x) for x in ragged_to_list(out["seq"])] == [3, 1, 2]
+    assert list(out["id"]) == ["sample_3", "sample_1", "sample_2"]
+
+    out = RaggedCollate({"0": "pad"}, pad_value=-1)([(np.arange(2), "é"), (np.arange(1), "")])
+    np.testing.assert_array_equal(out[0]["values"], [[0, 1], [0, -1]])
+    assert decode_strings(out[1]) == ["é", ""]
+
+    out = RaggedCollate({"id": "pad"}, pad_value=-1)([{"id": "ab"}, {"id": "a"}])
+    np.testing.assert_array_equal(out["id"]["values"], [[97, 98], [97, 0]])
+
+    with pytest.raises(ValueError):
+        RaggedCollate(default="foo")
+
+
+def test_batch_gen(data):
+    from kipoi_utils.data_utils import batch_gen
+
+    samples = [get_dataset_item(data, i) for i in range(3)]
+    for prefetch in [0, 2]:
+        batches = list(batch_gen(iter(samples), batch_size=2, prefetch=prefetch))
+        assert [len(b["c"]) for b in batches] == [2, 1]
+        np.testing.assert_array_equal(batches[1]["b"]["d"], [2])
+
+        # nested arrays are sliced directly
+        sliced = list(batch_gen(data, batch_size=2, prefetch=prefetch))
+        assert [len(b["c"]) for b in sliced] == [2, 1]
+        np.testing.assert_array_equal(sliced[0]["a"][0], batches[0]["a"][0])
+        np.testing.assert_array_equal(sliced[1]["c"], batches[1]["c"])
+        assert np.shares_memory(sliced[0]["c"], data["c"])
+
+    assert [len(b) for b in batch_gen(np.arange(5), 2)] == [2, 2, 1]
+
+    def failing():
+        yield 1
+        raise ValueError("failed")
+    with pytest.raises(ValueError):
+        list(batch_gen(failing(), batch_size=1, prefetch=1))
+    # abandoned prefetching generator
+    gen = batch_gen(range(100), batch_size=1, prefetch=1)
+    next(gen)
+    gen.close()
+
+
+def test_batch_gen_bad_data(bad_data):
+    from kipoi_utils.data_utils import batch_gen
+    with pytest.raises(ValueError):
+        list(batch_gen(bad_data, 2))
+
+
+def test_nested_array_dataset(data, bad_data, tmpdir):
+    import pickle
+    from kipoi_utils.data_utils import NestedArrayDataset
+    from kipoi_utils.external.torch.data import DataLoader
+
+    ds = NestedArrayDataset(data)
+    assert len(ds) == 3
+    assert ds[1] == get_dataset_item(data, 1)
+    batch = ds.get_batch([2, 0])
+    np.testing.assert_array_equal(batch["b"]["d"], [2, 0])
+    np.testing.assert_array_equal(batch["c"], [[2], [0]])
+    with pytest.raises(ValueError):
+        NestedArrayDataset(bad_data)
+
+    path = str(tmpdir.join("ds"))
+    ds.save(path)
+    loaded = NestedArrayDataset.load(path)
+    assert isinstance(loaded.leaves[0], np.memmap)
+    np.testing.assert_array_equal(loaded.get_batch([1])["a"][0], [1])
+    # pickled by path
+    assert len(pickle.dumps(loaded)) < 200
+    assert pickle.loads(pickle.dumps(loaded))[2] == ds[2]
+
+    batches = list(DataLoader(loaded, batch_size=2, num_workers=2))
+    np.testing.assert_array_equal(batches[1]["c"], [[2]])
+
+    # object arrays of strings are saved as fixed-width strings
+    ids = np.array(["chr1", "chr10", "chrX"], dtype=object)
+    ds = NestedArrayDataset({"id": ids, "raw": ids.astype(bytes).astype(object)})
+    ds.save(path)
+    for mmap_mode in ['r', None]:
+        loaded = NestedArrayDataset.load(path, mmap_mode)
+        assert loaded.leaves[0].dtype == np.dtype('<U5')
+        assert loaded.leaves[1].dtype == np.dtype('S5')
+        assert list(loaded.get_batch([1, 0])["id"]) == ["chr10", "chr1"]
+    with pytest.raises(ValueError):
+        NestedArrayDataset({"a": np.array([1, "a", None], dtype=object)}).save(path)
+
+
+def test_dataset_lens_flat():
+    assert get_dataset_lens({"a": [np.arange(2)] * 1000}) == [2] * 1000
+
+
+def test_flatten_batch_columnar():
+    import pandas as pd
+    from kipoi_utils.data_utils import flatten_batch, flatten_batch_columnar
+
+    preds = np.random.rand(4, 3, 2)
+    batch = {"preds": preds,
+             "metadata": {"id": np.arange(4), "table": pd.DataFrame({"a": np.arange(4), "b": list("wxyz")})}}
+    blocks = flatten_batch_columnar(batch)
+    assert list(blocks) == ["preds", "metadata/id", "metadata/table/a", "metadata/table/b"]
+    block = blocks["preds"]
+    assert block.values.shape == (4, 6)
+    assert np.shares_memory(block.values, preds)
+    assert len(block) == 6
+    assert block.columns[:3] == ["preds/0/0", "preds/0/1", "preds/1/0"]
+    np.testing.assert_array_equal(block.values[:, 3], preds[:, 1, 1])
+
+    flat = flatten_batch(batch)
+    assert len(flat) == 6 + 3
+    np.testing.assert_array_equal(flat["preds/1/1"], preds[:, 1, 1])
+    assert list(flat["metadata/table/b"]) == list("wxyz")
+    with pytest.raises(ValueError):
+        flatten_batch({"a": object()})
@@ -0,0 +1,517 @@
+"""Test the DataLoader in kipoi_utils.external.torch
+"""
+import asyncio
+import gc
+import numpy as np
+import pytest
+from kipoi_utils.external.torch.data import DataLoader
+from kipoi_utils.external.torch.sampler import (RandomSampler, ArraySequentialSampler,
+                                                ArrayBatchSampler)
+
+
+class ArrayDataset(object):
+    def __init__(self, n=20):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        return {"inputs": np.full((3, 4), idx, dtype=np.float32),
+                "targets": [np.array(idx), idx],
+                "metadata": {"id": str(idx)}}
+
+
+def check_batches(batches, n, batch_size):
+    idx = np.concatenate([b["targets"][1] for b in batches])
+    assert list(idx) == list(range(n))
+    for b in batches:
+        assert b["inputs"].shape == (len(b["targets"][1]), 3, 4)
+        assert np.all(b["inputs"][:, 0, 0] == b["targets"][0])
+        assert list(b["metadata"]["id"]) == [str(i) for i in b["targets"][1]]
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_dataloader(num_workers):
+    dl = DataLoader(ArrayDataset(), batch_size=3, num_workers=num_workers)
+    check_batches(list(dl), 20, 3)
+
+
+def test_dataloader_shared_memory():
+    dl = DataLoader(ArrayDataset(), batch_size=3, num_workers=2, shared_memory=True)
+    it = iter(dl)
+    batches = list(it)
+    check_batches(batches, 20, 3)
+    # the arrays are views into the shared slabs
+    assert not batches[0]["inputs"].flags.owndata
+
+    # batches too large for a slab are sent as usual
+    dl = DataLoader(ArrayDataset(), batch_size=3, num_workers=2, shared_memory=True,
+                    shared_memory_slab_size=8)
+    batches = list(dl)
+    check_batches(batches, 20, 3)
+    assert batches[0]["inputs"].flags.owndata
+
+
+def test_dataloader_shared_memory_reuse():
+    # consuming batches one at a time only requires a few slabs
+    dl = DataLoader(ArrayDataset(100), batch_size=2, num_workers=2, shared_memory=True)
+    n = 0
+    for b in dl:
+        assert not b["inputs"].flags.owndata
+        n += len(b["inputs"])
+        del b
+        gc.collect()
+    assert n == 100
+
+
+def test_shared_memory_slabs_outlive_pool():
+    import sys
+    from kipoi_utils.external.torch.shared_memory import SlabPool
+
+    unraisable = []
+    hook = sys.unraisablehook
+    sys.unraisablehook = unraisable.append
+    try:
+        # views outliving the pool
+        pool = SlabPool(2, 1024)
+        batch = pool.read(pool.write({"x": np.arange(10)}))
+        pool.close()
+        del pool
+        gc.collect()
+        assert list(batch["x"]) == list(range(10))
+        del batch
+
+        # pool and views garbage-collected together in a reference cycle
+        pool = SlabPool(2, 1024)
+        cycle = [pool.read(pool.write({"x": np.arange(10)}))]
+        cycle.append(cycle)
+        del pool, cycle
+        gc.collect()
+    finally:
+        sys.unraisablehook = hook
+    assert unraisable == []
+
+
+class BuildDataset(ArrayDataset):
+    def __init__(self, n=20):
+        super(BuildDataset, self).__init__(n)
+        self.n_builds = 0
+
+    def build(self):
+        self.n_builds += 1
+
+
+def test_dataloader_thread_backend():
+    ds = BuildDataset()
+    dl = DataLoader(ds, batch_size=3, num_workers=3, worker_backend='thread')
+    check_batches(list(dl), 20, 3)
+    assert ds.n_builds == 1
+
+    with pytest.raises(ValueError):
+        DataLoader(ds, num_workers=2, worker_backend='foo')
+    with pytest.raises(ValueError):
+        DataLoader(ds, num_workers=2, worker_backend='thread', shared_memory=True)
+
+
+class GetBatchDataset(ArrayDataset):
+    def get_batch(self, indices):
+        indices = np.asarray(indices)
+        return {"inputs": np.repeat(indices.astype(np.float32), 12).reshape((-1, 3, 4)),
+                "targets": [indices, indices],
+                "metadata": {"id": indices.astype(str)}}
+
+
+class GetItemsDataset(ArrayDataset):
+    def __getitems__(self, indices):
+        return [self[i] for i in indices]
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("cls", [GetBatchDataset, GetItemsDataset])
+def test_dataloader_batched_access(cls, num_workers):
+    dl = DataLoader(cls(), batch_size=3, num_workers=num_workers)
+    check_batches(list(dl), 20, 3)
+
+
+class WorkerBuildDataset(ArrayDataset):
+    """Records the number of worker builds in a shared counter"""
+
+    def __init__(self, n=20):
+        import multiprocessing
+        super(WorkerBuildDataset, self).__init__(n)
+        self.n_builds = multiprocessing.Value('i', 0)
+
+    def build(self):
+        with self.n_builds.get_lock():
+            self.n_builds.value += 1
+
+
+@pytest.mark.parametrize("shared_memory", [False, True])
+def test_dataloader_persistent_workers(shared_memory):
+    ds = WorkerBuildDataset()
+    dl = DataLoader(ds, batch_size=3, num_workers=2, persistent_workers=True,
+                    prefetch_factor=3, shared_memory=shared_memory)
+    for _ in range(3):
+        check_batches(list(dl), 20, 3)
+    workers = dl._iterator.workers
+    assert all(w.is_alive() for w in workers)
+
+    # interrupt an epoch
+    it = iter(dl)
+    next(it)
+    check_batches(list(dl), 20, 3)
+    assert dl._iterator.workers is workers
+    assert ds.n_builds.value == 2
+
+    with pytest.raises(ValueError):
+        DataLoader(ds, persistent_workers=True)
+    with pytest.raises(ValueError):
+        DataLoader(ds, num_workers=1, prefetch_factor=0)
+
+
+class SlowFirstDataset(ArrayDataset):
+    def __getitem__(self, idx):
+        if idx == 0:
+            import time
+            time.sleep(0.5)
+        return super(SlowFirstDataset, self).__getitem__(idx)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_dataloader_unordered(num_workers):
+    dl = DataLoader(SlowFirstDataset(), batch_size=3, num_workers=num_workers, in_order=False)
+    out = list(dl)
+    if num_workers > 0:
+        # the slow first batch doesn't block the others
+        assert out[0][0] != 0
+    assert sorted(i for i, b in out) == list(range(7))
+    check_batches([b for i, b in sorted(out, key=lambda x: x[0])], 20, 3)
+
+
+def test_dataloader_max_inflight_bytes():
+    # batches take up about 210 bytes
+    dl = DataLoader(ArrayDataset(), batch_size=3, num_workers=2, prefetch_factor=4,
+                    max_inflight_bytes=300)
+    it = iter(dl)
+    assert it.inflight_bytes == 0
+    batches = []
+    for b in it:
+        batches.append(b)
+        # scheduling stops once the budget is reached
+        assert it.batches_outstanding + len(it.reorder_dict) <= 2
+        assert it.inflight_bytes < 300 + 220
+    check_batches(batches, 20, 3)
+
+
+async def _collect(dl):
+    return [b async for b in dl]
+
+
+async def _collect_all(dls):
+    return await asyncio.gather(*[_collect(dl) for dl in dls])
+
+
+@pytest.mark.parametrize("kwargs", [dict(num_workers=0),
+                                    dict(num_workers=2),
+                                    dict(num_workers=2, pin_memory=True),
+                                    dict(num_workers=2, worker_backend='thread')])
+def test_dataloader_async(kwargs):
+    loop = asyncio.new_event_loop()
+    try:
+        # several loaders progressing concurrently on a single loop
+        dls = [DataLoader(ArrayDataset(), batch_size=3, **kwargs) for _ in range(3)]
+        results = loop.run_until_complete(_collect_all(dls))
+    finally:
+        loop.close()
+    for batches in results:
+        check_batches(batches, 20, 3)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_dataloader_stats(num_workers):
+    dl = DataLoader(ArrayDataset(), batch_size=3, num_workers=num_workers)
+    assert dl.stats()["batches"] == 0
+    for b in dl:
+        pass
+    stats = dl.stats()
+    assert stats["batches"] == 7
+    assert stats["num_workers"] == num_workers
+    assert stats["fetch_time"] > 0
+    assert stats["collate_time"] > 0
+    assert stats["consumer_wait_time"] > 0
+    if num_workers:
+        assert stats["queue_time"] > 0
+        assert 0 <= stats["reorder_size_mean"] <= stats["reorder_size_max"]
+
+
+class TableDataset(object):
+    """Dataset loading a large table in build"""
+
+    def __init__(self, n=20):
+        import multiprocessing
+        self.n = n
+        self.n_builds = multiprocessing.Value('i', 0)
+        self.table = None
+
+    def build(self):
+        import pandas as pd
+        with self.n_builds.get_lock():
+            self.n_builds.value += 1
+        self.values = np.arange(self.n * 10000, dtype=np.float64).reshape((self.n, -1))
+        self.table = pd.DataFrame({"start": np.arange(100000) * 10,
+                                   "score": np.random.rand(100000)})
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        return {"values": self.values[idx],
+                "start": self.table.start.values[idx],
+                "writeable": self.values.flags.writeable}
+
+    def __reduce__(self):
+        # multiprocessing.Value can only be shared via inheritance
+        return (_rebuild_table_dataset, (self.n, self.values, self.table))
+
+
+def _rebuild_table_dataset(n, values, table):
+    ds = TableDataset.__new__(TableDataset)
+    ds.n, ds.values, ds.table, ds.n_builds = n, values, table, None
+    return ds
+
+
+def test_dataloader_share_dataset():
+    ds = TableDataset()
+    dl = DataLoader(ds, batch_size=3, num_workers=2, share_dataset=True)
+    it = iter(dl)
+    batches = list(it)
+    assert ds.n_builds.value == 1
+    # values and the pandas blocks
+    assert len(it.shared_dataset.slabs) >= 2
+    np.testing.assert_equal(np.concatenate([b["values"] for b in batches]), ds.values)
+    np.testing.assert_equal(np.concatenate([b["start"] for b in batches]), ds.table.start.values[:20])
+    # workers see the shared arrays read-only
+    assert not np.any(np.concatenate([b["writeable"] for b in batches]))
+
+
+class SlowDataset(ArrayDataset):
+    def __getitem__(self, idx):
+        import time
+        time.sleep(0.005)
+        return super(SlowDataset, self).__getitem__(idx)
+
+
+@pytest.mark.parametrize("worker_backend", ["process", "thread"])
+def test_dataloader_autoscale(worker_backend):
+    import time
+    # slow dataset, fast consumer: add workers
+    dl = DataLoader(SlowDataset(120), batch_size=2, num_workers=1, min_workers=1, max_workers=3,
+                    worker_backend=worker_backend)
+    batches = list(dl)
+    assert dl.stats()["num_workers"] == 3
+    check_batches(batches, 120, 2)
+
+    # fast dataset, slow consumer: retire workers
+    dl = DataLoader(ArrayDataset(120), batch_size=2, num_workers=3, min_workers=1, max_workers=3,
+                    worker_backend=worker_backend)
+    batches = []
+    for b in dl:
+        time.sleep(0.005)
+        batches.append(b)
+    assert dl.stats()["num_workers"] == 1
+    check_batches(batches, 120, 2)
+
+    with pytest.raises(ValueError):
+        DataLoader(ArrayDataset(), num_workers=2, min_workers=1)
+    with pytest.raises(ValueError):
+        DataLoader(ArrayDataset(), num_workers=4, min_workers=1, max_workers=3)
+
+
+class AsyncDataset(ArrayDataset):
+    def __init__(self, n=20):
+        super(AsyncDataset, self).__init__(n)
+        self.running = 0
+        self.max_running = 0
+
+    async def aget(self, idx):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        return self[idx]
+
+
+@pytest.mark.parametrize("kwargs", [dict(num_workers=0),
+                                    dict(num_workers=2),
+                                    dict(num_workers=2, worker_backend='thread')])
+def test_dataloader_aget(kwargs):
+    ds = AsyncDataset()
+    dl = DataLoader(ds, batch_size=5, async_limit=3, **kwargs)
+    check_batches(list(dl), 20, 5)
+    if kwargs['num_workers'] == 0:
+        assert ds.max_running == 3
+    elif kwargs.get('worker_backend') == 'thread':
+        # up to async_limit samples per worker thread
+        assert 3 <= ds.max_running <= 6
+
+    # async iteration without workers uses the running event loop
+    ds = AsyncDataset()
+    loop = asyncio.new_event_loop()
+    try:
+        batches = loop.run_until_complete(_collect(DataLoader(ds, batch_size=5)))
+    finally:
+        loop.close()
+    check_batches(batches, 20, 5)
+    assert ds.max_running == 5
+
+
+@pytest.mark.parametrize("kwargs", [dict(num_workers=0),
+                                    dict(num_workers=2, transform_workers=2),
+                                    dict(num_workers=2, shared_memory=True, pin_memory=True)])
+def test_dataloader_transforms(kwargs):
+    import threading
+    from kipoi_utils.data_utils import cast_transform, contiguous_transform
+
+    threads = []
+
+    def record_thread(batch):
+        threads.append(threading.current_thread())
+        return batch
+
+    dl = DataLoader(ArrayDataset(), batch_size=3,
+                    transforms=[cast_transform(np.float64, np.float32, path="inputs"),
+                                contiguous_transform(),
+                                record_thread],
+                    **kwargs)
+    batches = list(dl)
+    check_batches(batches, 20, 3)
+    assert all(b["inputs"].dtype == np.float64 for b in batches)
+    assert len(threads) == 7
+    if kwargs['num_workers'] > 0:
+        assert threading.main_thread() not in threads
+
+
+def test_dataloader_transform_threads_exit():
+    import threading
+    import time
+
+    n_threads = threading.active_count()
+    dl = DataLoader(ArrayDataset(), batch_size=3, num_workers=1, transform_workers=4,
+                    transforms=[lambda batch: batch])
+    for _ in range(5):
+        check_batches(list(dl), 20, 3)
+    gc.collect()
+    # the threads exit once they got the sentinel of the exited worker
+    for _ in range(100):
+        if threading.active_count() <= n_threads:
+            break
+        time.sleep(0.05)
+    assert threading.active_count() <= n_threads
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("policy", ["round_robin", "weighted", "as_ready"])
+def test_interleaved_dataloader(policy, num_workers):
+    from kipoi_utils.external.torch.data import InterleavedDataLoader
+    datasets = {"chr1": ArrayDataset(20), "chr2": ArrayDataset(7), "chr3": ArrayDataset(4)}
+    dl = InterleavedDataLoader(datasets, policy=policy, weights={"chr1": 3, "chr2": 1, "chr3": 1},
+                               batch_size=3, num_workers=num_workers, seed=1,
+                               transforms=[lambda b: dict(b, transformed=True)])
+    assert len(dl) == 7 + 3 + 2
+    out = list(dl)
+    assert len(out) == 12
+    if policy == "round_robin":
+        assert [name for name, b in out][:6] == ["chr1", "chr2", "chr3"] * 2
+    for name in datasets:
+        batches = [b for n, b in out if n == name]
+        assert all(b["transformed"] for b in batches)
+        if policy != "as_ready":
+            check_batches(batches, len(datasets[name]), 3)
+        else:
+            assert sorted(np.concatenate([b["targets"][1] for b in batches])) == \
+                list(range(len(datasets[name])))
+
+
+class AsyncOnlyDataset(object):
+    def __init__(self, n):
+        self.dataset = AsyncDataset(n)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    async def aget(self, idx):
+        return await self.dataset.aget(idx)
+
+
+@pytest.mark.parametrize("kwargs", [dict(num_workers=0),
+                                    dict(num_workers=2),
+                                    dict(num_workers=2, worker_backend='thread')])
+def test_interleaved_dataloader_aget(kwargs):
+    from kipoi_utils.external.torch.data import InterleavedDataLoader
+    datasets = {"chr1": AsyncOnlyDataset(20), "chr2": AsyncDataset(7)}
+    dl = InterleavedDataLoader(datasets, batch_size=5, async_limit=3, **kwargs)
+    out = list(dl)
+    for name in datasets:
+        check_batches([b for n, b in out if n == name], len(datasets[name]), 5)
+    if kwargs['num_workers'] == 0:
+        # samples loaded concurrently
+        assert datasets["chr1"].dataset.max_running == 3
+        assert datasets["chr2"].max_running == 3
+
+
+@pytest.mark.parametrize("kwargs", [dict(num_workers=0), dict(num_workers=2),
+                                    dict(num_workers=0, in_order=False),
+                                    dict(num_workers=2, in_order=False),
+                                    dict(num_workers=2, persistent_workers=True)])
+def test_dataloader_state_dict(kwargs):
+    def make():
+        ds = ArrayDataset()
+        return DataLoader(ds, batch_size=3, sampler=RandomSampler(ds, seed=0), **kwargs)
+
+    def ids(batches):
+        if kwargs.get('in_order', True):
+            return [list(b["targets"][1]) for b in batches]
+        return sorted((i, list(b["targets"][1])) for i, b in batches)
+
+    def samples(batches):
+        if not kwargs.get('in_order', True):
+            batches = [b for i, b in batches]
+        return set(i for b in batches for i in b["targets"][1])
+
+    dl = make()
+    assert dl.state_dict()['num_delivered'] == 0
+    it = iter(dl)
+    head = [next(it) for _ in range(3)]
+    state = dl.state_dict()
+    tail = list(it)
+    next_epoch = ids(dl)
+    assert len(state['delivered']) + state['num_delivered'] == 3
+    outstanding = [i for idx in state['outstanding'].values() for i in idx]
+    assert not set(outstanding) & samples(head)
+
+    # continue in a new DataLoader
+    dl = make()
+    dl.load_state_dict(state)
+    resumed = list(dl)
+    assert ids(resumed) == ids(tail)
+    if kwargs.get('in_order', True):
+        assert ids(resumed) == ids(head + tail)[3:]
+    else:
+        # the batch positions are kept
+        assert sorted(ids(head) + ids(resumed)) == ids(head + tail)
+    assert ids(dl) == next_epoch
+
+    # the state of a complete epoch resumes with the next one
+    state = dl.state_dict()
+    dl = make()
+    dl.load_state_dict(state)
+    assert len(ids(dl)) == 7
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_dataloader_array_batch_sampler(num_workers):
+    ds = ArrayDataset()
+    batch_sampler = ArrayBatchSampler(ArraySequentialSampler(ds), 3, False)
+    dl = DataLoader(ds, batch_sampler=batch_sampler, num_workers=num_workers)
+    check_batches(list(dl), 20, 3)
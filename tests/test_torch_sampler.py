@@ -0,0 +1,219 @@
+"""Test the samplers in kipoi_utils.external.torch
+"""
+import numpy as np
+import pytest
+from kipoi_utils.external.torch.sampler import (SequentialSampler, RandomSampler, BatchSampler,
+                                                InterleavedBatchSampler, ShardedSampler,
+                                                ArraySequentialSampler, ArrayRandomSampler,
+                                                ArraySubsetRandomSampler, ArrayBatchSampler,
+                                                BlockShuffleSampler, BucketBatchSampler,
+                                                WeightedRandomSampler, StratifiedBatchSampler,
+                                                _AliasTable)
+
+
+def test_sampler_state_dict():
+    s = BatchSampler(RandomSampler(range(10), seed=1), 3, False)
+    first = list(s)
+    state = s.state_dict()
+    second = list(s)
+    assert first != second
+
+    # a new sampler reproduces the saved iteration and the following ones
+    s = BatchSampler(RandomSampler(range(10), seed=1), 3, False)
+    s.load_state_dict(state)
+    assert list(s) == first
+    assert list(s) == second
+
+    # unseeded sampler
+    s = RandomSampler(range(10))
+    it = list(s)
+    state = s.state_dict()
+    s = RandomSampler(range(10))
+    s.load_state_dict(state)
+    assert list(s) == it
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_sharded_sampler(shuffle):
+    data = range(10)
+    shards = [list(ShardedSampler(data, 3, i, shuffle=shuffle, pad=False)) for i in range(3)]
+    assert [len(x) for x in shards] == [4, 3, 3]
+    assert sorted(np.concatenate(shards)) == list(data)
+    if not shuffle:
+        assert shards[1] == [4, 5, 6]
+
+    shards = [ShardedSampler(data, 3, i, shuffle=shuffle, seed=1) for i in range(3)]
+    assert [len(s) for s in shards] == [4, 4, 4]
+    idx = np.concatenate([list(s) for s in shards])
+    assert set(idx) == set(data)
+    assert len(idx) == 12
+
+    if shuffle:
+        # same permutation for the same epoch, different one for the next epoch
+        assert list(shards[0]) == list(ShardedSampler(data, 3, 0, shuffle=True, seed=1))
+        s = ShardedSampler(data, 3, 0, shuffle=True, seed=1)
+        s.set_epoch(1)
+        assert list(s) != list(shards[0])
+        state = s.state_dict()
+        s2 = ShardedSampler(data, 3, 0, shuffle=True, seed=1)
+        s2.load_state_dict(state)
+        assert list(s2) == list(s)
+
+    assert list(BatchSampler(shards[2], 3, False))[-1] == [idx[-1]]
+    with pytest.raises(ValueError):
+        ShardedSampler(data, 3, 3)
+
+
+def test_interleaved_batch_sampler():
+    samplers = [BatchSampler(SequentialSampler(range(n)), 2, False) for n in [5, 2, 0]]
+    s = InterleavedBatchSampler(samplers)
+    assert len(s) == 4
+    assert list(s) == [[(0, 0), (0, 1)], [(1, 0), (1, 1)], [(0, 2), (0, 3)], [(0, 4)]]
+
+    s = InterleavedBatchSampler(samplers, 'weighted', weights=[1, 0, 1], seed=0)
+    assert sorted(map(tuple, s)) == sorted(map(tuple, InterleavedBatchSampler(samplers)))
+
+    with pytest.raises(ValueError):
+        InterleavedBatchSampler(samplers, 'weighted')
+    with pytest.raises(ValueError):
+        InterleavedBatchSampler(samplers, 'foo')
+
+
+def test_interleaved_batch_sampler_state_dict():
+    def make():
+        return InterleavedBatchSampler([BatchSampler(RandomSampler(range(n)), 2, False)
+                                        for n in [5, 6]], 'weighted', weights=[1, 2])
+    s = make()
+    first = list(s)
+    state = s.state_dict()
+    s = make()
+    s.load_state_dict(state)
+    assert list(s) == first
+
+
+def test_array_samplers():
+    idx = ArraySequentialSampler(range(10)).indices()
+    assert idx.dtype == np.int32
+    assert list(idx) == list(range(10))
+
+    s = ArrayRandomSampler(range(10), generator=np.random.default_rng(0))
+    perm = s.indices()
+    assert perm.dtype == np.int32
+    assert sorted(perm) == list(range(10))
+    assert list(perm) == list(ArrayRandomSampler(range(10), np.random.default_rng(0)))
+
+    s = ArraySubsetRandomSampler([3, 5, 7], generator=np.random.default_rng(0))
+    assert len(s) == 3
+    assert sorted(s) == [3, 5, 7]
+
+    batches = list(ArrayBatchSampler(ArraySequentialSampler(range(7)), 3, False))
+    assert [list(b) for b in batches] == [[0, 1, 2], [3, 4, 5], [6]]
+    # views into a single array
+    assert batches[0].base is batches[1].base
+    assert len(list(ArrayBatchSampler(ArraySequentialSampler(range(7)), 3, True))) == 2
+    # samplers without indices()
+    assert [list(b) for b in ArrayBatchSampler(SequentialSampler(range(3)), 2, False)] == [[0, 1], [2]]
+
+
+def test_array_sampler_state_dict():
+    s = ArrayBatchSampler(ArrayRandomSampler(range(10), np.random.default_rng(1)), 3, False)
+    first = [list(b) for b in s]
+    state = s.state_dict()
+    second = [list(b) for b in s]
+
+    s = ArrayBatchSampler(ArrayRandomSampler(range(10)), 3, False)
+    s.load_state_dict(state)
+    assert [list(b) for b in s] == first
+    assert [list(b) for b in s] == second
+
+
+def test_block_shuffle_sampler():
+    s = BlockShuffleSampler(range(10), 4, generator=np.random.default_rng(0))
+    idx = s.indices()
+    assert len(s) == 10
+    assert sorted(idx) == list(range(10))
+    # the blocks of contiguous indices are kept together
+    pos = np.argsort(idx)
+    for block in [range(0, 4), range(4, 8), range(8, 10)]:
+        assert list(pos[block]) == list(range(pos[block[0]], pos[block[0]] + len(block)))
+
+    # sorted by chromosome and position within the windows
+    chrom = np.array([1, 0, 1, 0, 1, 0, 1, 0, 1, 0])
+    pos = np.arange(10)[::-1]
+    s = BlockShuffleSampler(range(10), 2, shuffle_window=5, sort_key=[chrom, pos],
+                            generator=np.random.default_rng(0))
+    idx = s.indices()
+    assert sorted(idx) == list(range(10))
+    for window in [idx[:5], idx[5:]]:
+        keys = list(zip(chrom[window], pos[window]))
+        assert keys == sorted(keys)
+
+    with pytest.raises(ValueError):
+        BlockShuffleSampler(range(10), 2, sort_key=np.arange(3))
+
+
+def test_bucket_batch_sampler():
+    lengths = np.array([5, 1, 3, 2, 5, 20, 1, 4, 3, 3])
+    s = BucketBatchSampler(lengths, max_tokens=10, generator=np.random.default_rng(0))
+    batches = list(s)
+    assert len(batches) == len(s)
+    assert sorted(np.concatenate(batches)) == list(range(10))
+    for b in batches:
+        assert len(b) == 1 or len(b) * lengths[b].max() <= 10
+    assert [list(b) for b in BucketBatchSampler(lengths, 10, shuffle=False)] == \
+        [[1, 6, 3], [2, 8, 9], [7, 0], [4], [5]]
+    assert max(len(b) for b in BucketBatchSampler(lengths, 10, max_batch_size=2)) == 2
+
+    state = s.state_dict()
+    s2 = BucketBatchSampler(lengths, max_tokens=10)
+    s2.load_state_dict(state)
+    assert [list(b) for b in s2] == [list(b) for b in batches]
+
+
+@pytest.mark.parametrize("weights", [[1, 2, 3, 4], [0, 0, 5, 1], [1] * 7, [10, 1e-3, 1e-3, 1e-3, 1e-3]])
+def test_alias_table(weights):
+    table = _AliasTable(weights)
+    assert np.all((table.prob >= 0) & (table.prob <= 1))
+    # probability of each index implied by the table
+    n = len(weights)
+    p = table.prob.copy()
+    np.add.at(p, table.alias, 1 - table.prob)
+    np.testing.assert_allclose(p / n, np.asarray(weights) / np.sum(weights), atol=1e-12)
+
+    draws = table.draw(np.random.default_rng(0), 100000)
+    freq = np.bincount(draws, minlength=n) / len(draws)
+    np.testing.assert_allclose(freq, np.asarray(weights) / np.sum(weights), atol=0.01)
+
+
+def test_weighted_random_sampler():
+    s = WeightedRandomSampler([0, 1, 3], num_samples=1000, generator=np.random.default_rng(0))
+    idx = list(s)
+    assert len(idx) == len(s) == 1000
+    assert 0 not in idx
+    assert 600 < idx.count(2) < 900
+
+    s = WeightedRandomSampler([0, 1, 3, 1e-9], num_samples=2, replacement=False,
+                              generator=np.random.default_rng(0))
+    assert all(len(set(s)) == 2 and 0 not in set(s) for _ in range(10))
+    with pytest.raises(ValueError):
+        WeightedRandomSampler([0, 1, 3], num_samples=3, replacement=False)
+    assert len(list(BatchSampler(WeightedRandomSampler([1, 2], 5), 2, False))) == 3
+
+
+def test_stratified_batch_sampler():
+    labels = np.array(["neg"] * 95 + ["pos"] * 5)
+    s = StratifiedBatchSampler(labels, batch_size=10, generator=np.random.default_rng(0))
+    batches = list(s)
+    assert len(batches) == len(s) == 10
+    for b in batches:
+        assert len(b) == 10
+        assert np.sum(labels[b] == "pos") == 5
+    # the rare class is cycled through
+    pos = np.concatenate([b[labels[b] == "pos"] for b in batches[:2]])
+    assert sorted(pos[:5]) == sorted(pos[5:]) == list(range(95, 100))
+
+    s = StratifiedBatchSampler(labels, batch_size=5, num_batches=100, class_weights={"neg": 3, "pos": 1},
+                               generator=np.random.default_rng(0))
+    n_pos = np.array([np.sum(labels[b] == "pos") for b in s])
+    assert set(n_pos) <= {1, 2}
+    assert 0.1 < np.mean(n_pos == 2) < 0.4